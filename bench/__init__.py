@@ -0,0 +1,2 @@
+from .corpora import SHAPES, SIZES, generate
+from .runner import LIBRARIES, BUILD_OPERATIONS, run, run_build, run_scaling, format_result, save_baseline, load_baseline, regressions
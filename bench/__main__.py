@@ -0,0 +1,49 @@
+import argparse
+import sys
+
+from . import SHAPES, SIZES, LIBRARIES, run, run_build, run_scaling, save_baseline, load_baseline, regressions
+
+
+# Usage: python -m bench [--shape S ...] [--size S ...] [--build NODES] [--scaling [--workers N ...]]
+#                       [--save-baseline PATH | --baseline PATH]
+# Exits with status 1 when a measurement regresses past the threshold against the baseline.
+def main(arguments=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Times e4 on synthetic corpora.')
+    parser.add_argument('--shape', action='append', choices=list(SHAPES), help='corpus shape, repeatable (default: all)')
+    parser.add_argument('--size', action='append', choices=list(SIZES), help='corpus size, repeatable (default: small and medium)')
+    parser.add_argument('--library', action='append', choices=list(LIBRARIES), help='library to time, repeatable (default: all)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per measurement, the best one is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc peak measurement')
+    parser.add_argument('--build', type=int, metavar='NODES', help='also time building and dumping documents of NODES elements')
+    parser.add_argument('--scaling', action='store_true',
+                        help='also time parse_many on threads and processes for each worker count, on the first shape and size')
+    parser.add_argument('--workers', type=int, action='append', metavar='N',
+                        help='worker count for --scaling, repeatable (default: 1, 2, 4, ... up to the number of cores)')
+    parser.add_argument('--documents', type=int, default=64, help='documents parsed per --scaling measurement')
+    parser.add_argument('--save-baseline', metavar='PATH', help='store the results as a baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='compare the results against a stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='tolerated slowdown against the baseline, as a fraction')
+    options = parser.parse_args(arguments)
+
+    results = run(options.shape, options.size or ['small', 'medium'], options.library, options.repeat,
+                  not options.no_memory, progress=print)
+    if options.build:
+        results.update(run_build(options.build, options.library, options.repeat, not options.no_memory, progress=print))
+    if options.scaling:
+        results.update(run_scaling((options.shape or ['wide'])[0], (options.size or ['small'])[0], options.documents,
+                                   options.workers, repeat=options.repeat, progress=print))
+
+    if options.save_baseline:
+        save_baseline(results, options.save_baseline)
+    if options.baseline:
+        slower = regressions(results, load_baseline(options.baseline), options.threshold)
+        for key, previous, current in slower:
+            print(f'REGRESSION {key}: {previous * 1000:.3f} ms -> {current * 1000:.3f} ms '
+                  f'({current / previous - 1:+.0%})', file=sys.stderr)
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
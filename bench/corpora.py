@@ -0,0 +1,96 @@
+import random
+
+from typing import Callable
+
+
+# Approximate document sizes in characters; generators stop at the first record past them
+SIZES = {
+    'small': 16 * 1024,
+    'medium': 1024 * 1024,
+    'large': 16 * 1024 * 1024,
+}
+
+_WORDS = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta', 'iota', 'kappa', 'lambda', 'mu']
+
+
+# Every corpus is generated from a fixed seed, so the same shape and size always give the
+# same text and timings stay comparable between runs and machines
+def generate(shape: str, size: str) -> str:
+    return SHAPES[shape](random.Random(f'{shape}/{size}'), SIZES[size])
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _records(rng: random.Random, limit: int, root: str, record: Callable[[random.Random, int], str]) -> str:
+    pieces = [f'<{root}>']
+    length = 0
+    index = 0
+    while length < limit:
+        piece = record(rng, index)
+        pieces.append(piece)
+        length += len(piece)
+        index += 1
+    pieces.append(f'</{root}>')
+    return ''.join(pieces)
+
+
+# Nested chains of elements, each a few hundred levels deep
+def _deep(rng: random.Random, limit: int) -> str:
+    def record(rng, index):
+        depth = rng.randint(100, 300)
+        return ''.join(f'<n{level % 10}>' for level in range(depth)) + str(index) + \
+            ''.join(f'</n{level % 10}>' for level in reversed(range(depth)))
+    return _records(rng, limit, 'deep', record)
+
+
+# A flat root with many small children
+def _wide(rng: random.Random, limit: int) -> str:
+    return _records(rng, limit, 'wide', lambda rng, index: f'<item>{index}</item>')
+
+
+def _attribute_heavy(rng: random.Random, limit: int) -> str:
+    def record(rng, index):
+        attributes = ' '.join(f'{rng.choice(_WORDS)}{key}="{rng.choice(_WORDS)}-{rng.randint(0, 9999)}"' for key in range(12))
+        return f'<entry id="{index}" {attributes}/>'
+    return _records(rng, limit, 'entries', record)
+
+
+def _text_heavy(rng: random.Random, limit: int) -> str:
+    def record(rng, index):
+        lines = '\n'.join(_sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 10)))
+        return f'<paragraph>{lines}</paragraph>\n'
+    return _records(rng, limit, 'text', record)
+
+
+def _reference_heavy(rng: random.Random, limit: int) -> str:
+    references = ['&amp;', '&lt;', '&gt;', '&quot;', '&apos;', '&#65;', '&#x263A;', '&#1234;']
+
+    def record(rng, index):
+        fragments = ''.join(f'{rng.choice(_WORDS)}{rng.choice(references)}' for _ in range(rng.randint(5, 15)))
+        return f'<line>{fragments}</line>'
+    return _records(rng, limit, 'references', record)
+
+
+def _namespaced(rng: random.Random, limit: int) -> str:
+    prefixes = ['a', 'b', 'svg', 'xlink']
+
+    def record(rng, index):
+        prefix = rng.choice(prefixes)
+        other = rng.choice(prefixes)
+        return f'<{prefix}:node {other}:ref="#{index}"><{other}:label>{rng.choice(_WORDS)}</{other}:label></{prefix}:node>'
+
+    declarations = ' '.join(f'xmlns:{prefix}="urn:bench:{prefix}"' for prefix in prefixes)
+    document = _records(rng, limit, 'ns:root', record)
+    return document.replace('<ns:root>', f'<ns:root xmlns:ns="urn:bench:ns" {declarations}>', 1)
+
+
+SHAPES = {
+    'deep': _deep,
+    'wide': _wide,
+    'attribute-heavy': _attribute_heavy,
+    'text-heavy': _text_heavy,
+    'reference-heavy': _reference_heavy,
+    'namespaced': _namespaced,
+}
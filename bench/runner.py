@@ -0,0 +1,242 @@
+import gc
+import io
+import json
+import os
+import time
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+
+from e4 import Element, parse, parse_document
+from e4.cache import encode, decode
+from e4.functions import TreeBuilder, clone, find_first
+from e4.io import dump, dump_document
+from e4.parallel import parse_many
+
+from . import corpora
+
+from typing import Callable
+
+
+# Each operation maps the corpus text to a prepared input and times one call on it.
+# find_first looks for a name no corpus uses, so it always scans the whole child list.
+# cache_load rebuilds the document from its binary cache in memory, to compare with parse.
+def _e4_operations(text: str) -> dict[str, tuple[Callable, object]]:
+    document = parse(text)
+    return {
+        'parse': (parse, text),
+        'parse_document': (parse_document, text),
+        'dump_document': (lambda document: dump_document(document, io.StringIO()), document),
+        'find_first': (lambda root: find_first(root, lambda fragment: isinstance(fragment, Element) and fragment.name == 'missing'),
+                       document.root),
+        'cache_load': (decode, encode(document)),
+    }
+
+
+# The standard library's ElementTree, timed on the same corpora as a point of reference
+def _etree_operations(text: str) -> dict[str, tuple[Callable, object]]:
+    root = ElementTree.fromstring(text)
+    return {
+        'parse': (ElementTree.fromstring, text),
+        'dump_document': (lambda root: ElementTree.tostring(root, encoding='unicode'), root),
+        'find_first': (lambda root: root.find('missing'), root),
+    }
+
+
+LIBRARIES = {
+    'e4': _e4_operations,
+    'etree': _etree_operations,
+}
+
+
+# Best of repeat timed calls, with the collector off as timeit does
+def _time(function: Callable, argument, repeat: int) -> float:
+    best = float('inf')
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(argument)
+            best = min(best, time.perf_counter() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+# Traced separately, since tracing slows allocation down too much to time alongside it
+def _peak_memory(function: Callable, argument) -> int:
+    tracemalloc.start()
+    try:
+        function(argument)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Returns {'shape/size/library/operation': {'seconds', 'throughput', 'peak'}}, with the
+# throughput in megabytes of corpus text per second
+def run(shapes=None, sizes=None, libraries=None, repeat: int = 5, memory: bool = True,
+        progress: Callable[[str], None] = None) -> dict[str, dict]:
+    results = {}
+    for shape in shapes or corpora.SHAPES:
+        for size in sizes or corpora.SIZES:
+            text = corpora.generate(shape, size)
+            for library in libraries or LIBRARIES:
+                for operation, (function, argument) in LIBRARIES[library](text).items():
+                    key = f'{shape}/{size}/{library}/{operation}'
+                    seconds = _time(function, argument, repeat)
+                    results[key] = {
+                        'seconds': seconds,
+                        'throughput': len(text) / seconds / 1e6 if seconds else float('inf'),
+                        'peak': _peak_memory(function, argument) if memory else None,
+                    }
+                    if progress is not None:
+                        progress(format_result(key, results[key]))
+    return results
+
+
+# Builds a feed of entries, each an element with an attribute and two text children, so that
+# nodes elements are created in total. With a template, entries are clones of it instead.
+def _e4_build(nodes: int, template: bool = False) -> Element:
+    builder = TreeBuilder()
+    builder.start('feed')
+    if template:
+        entry = Element(name='entry', attributes={'kind': 'note'}, fragments=[])
+        for name in ('title', 'value'):
+            child = Element(name=name, attributes={}, fragments=['text'], parent=entry)
+            entry.fragments.append(child)
+        builder.extend(clone(entry) for _ in range(nodes // 3))
+    else:
+        for number in range(nodes // 3):
+            builder.start('entry', {'id': str(number)})
+            builder.leaf('title', None, 'Entry title')
+            builder.leaf('value', None, str(number))
+            builder.end()
+    builder.end()
+    return builder.close()
+
+
+def _etree_build(nodes: int) -> ElementTree.Element:
+    builder = ElementTree.TreeBuilder()
+    builder.start('feed', {})
+    for number in range(nodes // 3):
+        builder.start('entry', {'id': str(number)})
+        for name, text in (('title', 'Entry title'), ('value', str(number))):
+            builder.start(name, {})
+            builder.data(text)
+            builder.end(name)
+        builder.end('entry')
+    builder.end('feed')
+    return builder.close()
+
+
+def _e4_dump(root: Element) -> str:
+    out = io.StringIO()
+    dump(root, out)
+    return out.getvalue()
+
+
+BUILD_OPERATIONS = {
+    'e4': {
+        'build': lambda nodes: _e4_build(nodes),
+        'build_from_template': lambda nodes: _e4_build(nodes, template=True),
+        'build_and_dump': lambda nodes: _e4_dump(_e4_build(nodes)),
+    },
+    'etree': {
+        'build': _etree_build,
+        'build_and_dump': lambda nodes: ElementTree.tostring(_etree_build(nodes), encoding='unicode'),
+    },
+}
+
+
+# Times generating documents of nodes elements, as run does for parsing. The throughput is
+# in megabytes of serialized output per second.
+def run_build(nodes: int = 1_000_000, libraries=None, repeat: int = 3, memory: bool = True,
+              progress: Callable[[str], None] = None) -> dict[str, dict]:
+    size = len(_e4_dump(_e4_build(nodes)))
+    results = {}
+    for library in libraries or BUILD_OPERATIONS:
+        for operation, function in BUILD_OPERATIONS[library].items():
+            key = f'build/{nodes}/{library}/{operation}'
+            seconds = _time(function, nodes, repeat)
+            results[key] = {
+                'seconds': seconds,
+                'throughput': size / seconds / 1e6 if seconds else float('inf'),
+                'peak': _peak_memory(function, nodes) if memory else None,
+            }
+            if progress is not None:
+                progress(format_result(key, results[key]))
+    return results
+
+
+# 1, 2, 4, ... up to the number of cores, and the number of cores itself
+def _worker_counts() -> list[int]:
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 < cores:
+        counts.append(counts[-1] * 2)
+    return counts + [cores] if cores > 1 else counts
+
+
+# Times parse_many over documents copies of one corpus for each executor and worker count,
+# against a serial loop over parse. Each result records its speedup over one worker of the
+# same executor, so the 1 to N core scaling can be read off directly. The pool is started
+# within the timed call, as it is for callers of parse_many.
+def run_scaling(shape: str = 'wide', size: str = 'small', documents: int = 64, workers: list[int] = None,
+                executors=('thread', 'process'), repeat: int = 3,
+                progress: Callable[[str], None] = None) -> dict[str, dict]:
+    text = corpora.generate(shape, size)
+    sources = [text] * documents
+    total = len(text) * documents
+    prefix = f'scaling/{shape}-{size}-x{documents}/e4'
+
+    def record(operation: str, seconds: float, single: float = None):
+        key = f'{prefix}/{operation}'
+        results[key] = {
+            'seconds': seconds,
+            'throughput': total / seconds / 1e6 if seconds else float('inf'),
+            'peak': None,
+            'speedup': single / seconds if single is not None and seconds else None,
+        }
+        if progress is not None:
+            progress(format_result(key, results[key]))
+
+    results = {}
+    record('parse_serial', _time(lambda sources: [parse(source) for source in sources], sources, repeat))
+    for executor in executors:
+        single = None
+        for count in sorted(workers or _worker_counts()):
+            seconds = _time(lambda sources: list(parse_many(sources, count, executor)), sources, repeat)
+            single = single or (seconds if count == 1 else None)
+            record(f'parse_many-{executor}-{count}', seconds, single)
+    return results
+
+
+def format_result(key: str, result: dict) -> str:
+    peak = f'{result["peak"] / 1024:12.1f} KiB' if result['peak'] is not None else ''
+    speedup = f' {result["speedup"]:6.2f}x' if result.get('speedup') is not None else ''
+    return f'{key:48} {result["seconds"] * 1000:12.3f} ms {result["throughput"]:10.2f} MB/s{speedup} {peak}'
+
+
+def save_baseline(results: dict[str, dict], path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=1, sort_keys=True)
+
+
+def load_baseline(path) -> dict[str, dict]:
+    with open(path) as file:
+        return json.load(file)
+
+
+# Returns (key, baseline seconds, current seconds) for every e4 measurement slower than its
+# baseline by more than threshold, a fraction. Reference timings are never gated.
+def regressions(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[tuple[str, float, float]]:
+    slower = []
+    for key, result in results.items():
+        if key.split('/')[2] != 'e4' or key not in baseline:
+            continue
+        previous = baseline[key]['seconds']
+        if result['seconds'] > previous * (1 + threshold):
+            slower.append((key, previous, result['seconds']))
+    return slower
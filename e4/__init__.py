@@ -1,9 +1,15 @@
 from __future__ import annotations
 from typing import Union
 
+import bisect
+import codecs
 import dataclasses
 import string
 import enum
+import mmap
+import os
+import re
+import weakref
 
 
 class FragmentType(enum.Enum):
@@ -13,96 +19,361 @@ class FragmentType(enum.Enum):
     CHAR_REFERENCE = enum.auto()
 
 
+# Only references are wrapped in a Fragment. Child elements are stored in Element.fragments
+# as the Element itself, which answers to the same kind/data attributes. Character data is
+# stored as a plain str, which has neither: this is a break from the wrapped model, and code
+# reading fragment.kind or fragment.data has to use fragment_kind(fragment) instead, and take
+# a str fragment as its own data.
 @dataclasses.dataclass
 class Fragment:
+    __slots__ = ('kind', 'data')
     kind: FragmentType
     data: Union[str, Element]
 
 
 @dataclasses.dataclass
 class Attribute:
+    __slots__ = ('key', 'value')
     key: str
     value: str
 
 
 @dataclasses.dataclass
 class Declaration:
+    __slots__ = ('version', 'encoding', 'standalone')
     version: str
     encoding: str
     standalone: bool
 
 
+# Maps offsets into text to 1-based (line, column) pairs. The offsets of the line starts are
+# only collected on the first lookup, after which each lookup is a binary search.
+class LineIndex:
+    __slots__ = ('text', '_line_starts')
+
+    def __init__(self, text: str):
+        self.text = text
+        self._line_starts = None
+
+    def line_column(self, offset: int) -> tuple[int, int]:
+        line_starts = self._line_starts
+        if line_starts is None:
+            line_starts = self._line_starts = [0]
+            line_starts.extend(match.end() for match in _LINE_END.finditer(self.text))
+        line = bisect.bisect_right(line_starts, offset)
+        return line, offset - line_starts[line - 1] + 1
+
+
+# Normalized text only contains '\n' line ends
+_LINE_END = re.compile('\n')
+
+
+# With the source text the position refers to, line and column are available on demand
+class BadFormat(Exception):
+    def __init__(self, message: str, position: int, source: str = None):
+        super().__init__(f'{message} at offset {position}')
+        self.position = position
+        self.source = source
+
+    @property
+    def line_column(self) -> tuple[int, int]:
+        if self.source is None:
+            return None
+        return LineIndex(self.source).line_column(self.position)
+
+
+# source and spans are only set by parsing with a spans table, see parse_document and reparse
 class Document:
-    def __init__(self, declaration: Declaration, root: Element):
+    __slots__ = ('declaration', 'root', 'source', 'spans', '_index', '_lines', '__weakref__')
+
+    def __init__(self, declaration: Declaration, root: Element, source: str = None, spans: dict[Element, list[int]] = None):
         self.declaration = declaration
         self.root = root
+        self.source = source
+        self.spans = spans
+        self._index = None
+        self._lines = None
+
+    # Line and column of the start tag of element, for documents parsed with a spans table
+    def line_column(self, element: Element) -> tuple[int, int]:
+        if self.spans is None:
+            raise ValueError('the document was not parsed with a spans table')
+        lines = self._lines
+        if lines is None or lines.text is not self.source:
+            lines = self._lines = LineIndex(self.source)
+        return lines.line_column(self.spans[element][0])
+
+    @property
+    def index(self) -> Index:
+        if self._index is None or self._index.stale or self._index.root is not self.root:
+            self._index = Index(self.root)
+            _indexed_documents[id(self.root)] = self
+        return self._index
+
+    def build_index(self, attribute_keys=()) -> Index:
+        index = self.index
+        for key in attribute_keys:
+            index.attribute_table(key)
+        return index
+
+    # The returned list is owned by the index and must not be modified
+    def find_all(self, name: str) -> list[Element]:
+        return self.index.by_name.get(name, [])
+
+    def find_by_attribute(self, key: str, value: str) -> Element:
+        return self.index.attribute_table(key).get(value)
 
 
+# The cached children and text lists are shared between calls, so they refuse to be changed
+# in place; trees are changed through their fragments. e4.functions extends the views with
+# list.append where it can keep them valid.
+class _View(list):
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('children and text are read-only views, change the fragments through e4.functions')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    # Copied and pickled as a new view, since the mutators are unavailable to rebuild one
+    def __reduce__(self):
+        return _View, (list(self),)
+
+
+# children and text are cached per element. Code that changes fragments has to go through
+# e4.functions, or call invalidate_views itself.
+# Elements without attributes hold None until attributes is first accessed, so parsed trees
+# carry no empty dicts. Code inside e4 reads _attributes to avoid creating them.
 class Element:
+    __slots__ = ('name', '_attributes', 'fragments', 'parent', '_children', '_text')
+
     name: str
-    attributes: dict[str, str]
-    fragments: list[Fragment]
+    fragments: list[Union[str, Element, Fragment]]
     parent: Element
 
+    kind = FragmentType.ELEMENT
+
     def __init__(self, *, name: str = '', attributes: dict[str, str] = None, fragments: list[Element] = None, parent=None):
         self.name = name
-        self.attributes = attributes if attributes is not None else dict()
+        self._attributes = attributes
         self.fragments = fragments if fragments is not None else []
         self.parent = parent
+        self._children = None
+        self._text = None
 
     @property
-    def children(self):
-        return [fragment.data for fragment in self.fragments if fragment.kind == FragmentType.ELEMENT]
+    def attributes(self) -> dict[str, str]:
+        attributes = self._attributes
+        if attributes is None:
+            attributes = self._attributes = {}
+        return attributes
+
+    @attributes.setter
+    def attributes(self, attributes: dict[str, str]):
+        self._attributes = attributes
 
     @property
-    def text(self):
-        return [fragment.data for fragment in self.fragments if fragment.kind in {FragmentType.CHAR_DATA, FragmentType.CHAR_REFERENCE, FragmentType.ENTITY_REFERENCE}]
+    def data(self) -> Element:
+        return self
+
+    @property
+    def children(self) -> list[Element]:
+        children = self._children
+        if children is None:
+            children = self._children = _View([fragment for fragment in self.fragments if isinstance(fragment, Element)])
+        return children
+
+    @property
+    def text(self) -> list[str]:
+        text = self._text
+        if text is None:
+            text = self._text = _View([fragment if isinstance(fragment, str) else fragment.data
+                                       for fragment in self.fragments if not isinstance(fragment, Element)])
+        return text
+
+
+# Elements by name, in document order, and the first element carrying each value of the
+# attribute keys queried so far. e4.functions keeps the index of a document up to date
+# when subtrees are inserted or removed. Subtrees appended at the very end of the document
+# are added to the lists in place; any other insertion marks the index stale, and
+# Document.index builds a new one on next use.
+class Index:
+    def __init__(self, root: Element):
+        self.root = root
+        self.by_name: dict[str, list[Element]] = {}
+        self.by_attribute: dict[str, dict[str, Element]] = {}
+        self.stale = False
+        self.add(root)
+
+    # Called with subtrees just inserted into the tree, in document order
+    def insert(self, subtrees: list[Element]):
+        if self.stale:
+            return
+        if not _ends_document(subtrees[-1]):
+            self.stale = True
+            return
+        for subtree in subtrees:
+            self.add(subtree)
+
+    def attribute_table(self, key: str) -> dict[str, Element]:
+        table = self.by_attribute.get(key)
+        if table is None:
+            table = self.by_attribute[key] = {}
+            for element in _iterate_subtree(self.root):
+                attributes = element._attributes
+                value = attributes.get(key) if attributes else None
+                if value is not None and value not in table:
+                    table[value] = element
+        return table
+
+    def add(self, subtree: Element):
+        by_name = self.by_name
+        by_attribute = self.by_attribute.items()
+        for element in _iterate_subtree(subtree):
+            elements = by_name.get(element.name)
+            if elements is None:
+                by_name[element.name] = [element]
+            else:
+                elements.append(element)
+            attributes = element._attributes
+            if attributes:
+                for key, table in by_attribute:
+                    value = attributes.get(key)
+                    if value is not None and value not in table:
+                        table[value] = element
+
+    # Called once subtree is out of the tree
+    def remove(self, subtree: Element):
+        if self.stale:
+            return
+        removed = list(_iterate_subtree(subtree))
+        removed_ids = {id(element) for element in removed}
+        for name in {element.name for element in removed}:
+            self.by_name[name] = [element for element in self.by_name[name] if id(element) not in removed_ids]
+        # Values whose first element was removed, by key, are refilled in one walk of the tree
+        lost = {}
+        for key, table in self.by_attribute.items():
+            for element in removed:
+                value = element._attributes.get(key) if element._attributes else None
+                if value is not None and table.get(value) is element:
+                    del table[value]
+                    lost.setdefault(key, set()).add(value)
+        if not lost:
+            return
+        for candidate in _iterate_subtree(self.root):
+            attributes = candidate._attributes
+            if not attributes:
+                continue
+            for key, values in lost.items():
+                value = attributes.get(key)
+                if value in values:
+                    self.by_attribute[key][value] = candidate
+                    values.discard(value)
+
+
+_indexed_documents = weakref.WeakValueDictionary()
+
+
+# Returns the index of the document element belongs to, if one has been built
+def index_of(element: Element) -> Index:
+    # Without any indexed document there is no need to climb to the root
+    if not _indexed_documents:
+        return None
+    while element.parent is not None:
+        element = element.parent
+    document = _indexed_documents.get(id(element))
+    if document is None or document._index is None or document._index.root is not element:
+        return None
+    return document._index
+
+
+# Whether no element follows the subtree of element in document order
+def _ends_document(element: Element) -> bool:
+    while element.parent is not None:
+        fragments = element.parent.fragments
+        for index in range(len(fragments) - 1, -1, -1):
+            fragment = fragments[index]
+            if isinstance(fragment, Element):
+                if fragment is not element:
+                    return False
+                break
+        element = element.parent
+    return True
 
 
+# Pre-order walk that leaves the cached views alone
+def _iterate_subtree(root: Element):
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        yield element
+        stack.extend(fragment for fragment in reversed(element.fragments) if isinstance(fragment, Element))
+
+
+def invalidate_views(element: Element):
+    element._children = None
+    element._text = None
+
+
+def fragment_kind(fragment: Union[str, Element, Fragment]) -> FragmentType:
+    return FragmentType.CHAR_DATA if isinstance(fragment, str) else fragment.kind
+
+
+# See https://www.w3.org/TR/xml/#sec-line-ends
 def normalize_end_of_line(content: str) -> str:
-    at = 0
-    normalized = ''
-    while at < len(content):
-        if content[at] in {'\x85', '\u2028'}:
-            normalized += '\x0A'
-        elif content[at] == '\x0D':
-            if at + 1 < len(content) and content[at + 1] in {'\x0A', '\x85'}:
-                at += 1
-            normalized += '\x0A'
-        else:
-            normalized += content[at]
-        at += 1
-    return normalized
+    # str.replace returns its argument unchanged when there is nothing to replace,
+    # so the common LF-only input costs a few scans and no copies
+    if '\x0D' in content:
+        content = content.replace('\x0D\x0A', '\x0A').replace('\x0D\x85', '\x0A').replace('\x0D', '\x0A')
+    return content.replace('\x85', '\x0A').replace('\u2028', '\x0A')
+
+
+# Normalizes a stream chunk by chunk. A trailing carriage return is held back until
+# the next chunk tells whether it starts a two-character line break.
+class EndOfLineNormalizer:
+    def __init__(self):
+        self.pending_carriage_return = False
+
+    def normalize(self, chunk: str, final: bool = False) -> str:
+        if self.pending_carriage_return:
+            chunk = '\x0D' + chunk
+            self.pending_carriage_return = False
+        if not final and chunk.endswith('\x0D'):
+            chunk = chunk[:-1]
+            self.pending_carriage_return = True
+        return normalize_end_of_line(chunk)
+
+
+# Character classes used by the productions below. Each run is consumed with a single
+# precompiled match instead of a per-character membership test.
+_WHITE_SPACE_CHARS = '\x20\x09\x0D\x0A'
+# TODO(Compliance):  add support for spec-allowed Unicode encoded characters
+_NAME_FIRST_CHARS = f':_{string.ascii_letters}'
+_NAME_NON_FIRST_CHARS = f'{_NAME_FIRST_CHARS}{string.digits}-.'
+
+_WHITE_SPACE = re.compile(f'[{_WHITE_SPACE_CHARS}]*')
+_CHAR_DATA = re.compile('[^<&]*')
+_NAME = re.compile(f'[{re.escape(_NAME_FIRST_CHARS)}][{re.escape(_NAME_NON_FIRST_CHARS)}]*')
+_CHAR_REFERENCE = re.compile('&#(?:x[0-9a-fA-F]+|[0-9]+);')
+_ATTRIBUTE_VALUE_RUN = {quote: re.compile(f'[^<&{quote}]*') for quote in '"\''}
 
 
 # See https://www.w3.org/TR/xml/#NT-S
 def parse_white_space(text: str, at: int) -> tuple[str, int, bool]:
-    allowed_chars = '\x20\x09\x0D\x0A'
-
-    current = at
-    ok = False
-    while current < len(text):
-        if text[current] not in allowed_chars:
-            break
-        current += 1
-        ok = True
-    return text[at:current], current, ok
+    current = _WHITE_SPACE.match(text, at).end()
+    return text[at:current], current, current > at
 
 
 # See https://www.w3.org/TR/xml/#NT-CharData
 def parse_char_data(text: str, at: int) -> tuple[str, int, bool]:
-    not_allowed_chars = '<&'
-
-    current = at
+    current = _CHAR_DATA.match(text, at).end()
     ok = True
-    while current < len(text):
-        if current + 2 < len(text) and text[current + 3] == ']]>':
-            ok = False
-            break
-        if text[current] in not_allowed_chars:
-            break
-        current += 1
-
+    # ']]>' contains neither '<' nor '&', so if present it lies entirely inside the run
+    end_of_cdata = text.find(']]>', at, current)
+    if end_of_cdata >= 0:
+        current = end_of_cdata
+        ok = False
     return text[at:current], current, ok
 
 
@@ -110,10 +381,10 @@ def parse_char_data(text: str, at: int) -> tuple[str, int, bool]:
 def parse_entity_reference(text: str, at: int) -> tuple[str, int, bool]:
     current = at
     ok = False
-    if text[current] == '&':
+    if text[current:current + 1] == '&':
         current += 1
         entity_name, current, parsed = parse_name(text, current)
-        if parsed and text[current] == ';':
+        if parsed and text[current:current + 1] == ';':
             current += 1
             ok = True
     return text[at:current], current, ok
@@ -121,25 +392,11 @@ def parse_entity_reference(text: str, at: int) -> tuple[str, int, bool]:
 
 # See https://www.w3.org/TR/xml/#NT-CharRef
 def parse_char_reference(text: str, at: int) -> tuple[str, int, bool]:
-    current = at
-    ok = False
-    if current + 1 < len(text) and text[current:current + 2] == '&#':
-        current += 2
-        allowed_chars = string.digits
-        if text[current] == 'x':
-            current += 1
-            allowed_chars += 'abcdefABCDEF'
-
-        parsed = False
-        while current < len(text) - 1 and text[current] in allowed_chars:
-            current += 1
-            parsed = True
-
-        if parsed and text[current] == ';':
-            current += 1
-            ok = True
-
-    return text[at:current], current, ok
+    match = _CHAR_REFERENCE.match(text, at)
+    if match is None:
+        return '', at, False
+    current = match.end()
+    return text[at:current], current, True
 
 
 # See https://www.w3.org/TR/xml/#NT-Reference
@@ -157,21 +414,32 @@ def parse_reference(text: str, at: int) -> tuple[str, int, bool, FragmentType]:
     return reference, current, ok, kind
 
 
+# See https://www.w3.org/TR/xml/#sec-predefined-ent
+_PREDEFINED_ENTITIES = {'&amp;': '&', '&lt;': '<', '&gt;': '>', '&quot;': '"', '&apos;': "'"}
+
+
+# See https://www.w3.org/TR/xml/#NT-Char
+def _is_char(code: int) -> bool:
+    return code in (0x9, 0xA, 0xD) or 0x20 <= code <= 0xD7FF or 0xE000 <= code <= 0xFFFD or 0x10000 <= code <= 0x10FFFF
+
+
+# Returns the text a reference stands for, or None when it cannot be resolved: entities other
+# than the predefined ones would need a DTD, and character references must denote a Char.
+# TODO(Compliance): resolve entities declared in the DTD
+def resolve_reference(reference: str) -> str:
+    if reference.startswith('&#'):
+        code = int(reference[3:-1], 16) if reference[2] == 'x' else int(reference[2:-1])
+        return chr(code) if _is_char(code) else None
+    return _PREDEFINED_ENTITIES.get(reference)
+
+
 # See https://www.w3.org/TR/xml/#NT-Name
-# TODO(Compliance):  add support for spec-allowed Unicode encoded characters
 def parse_name(text: str, at: int) -> tuple[str, int, bool]:
-    allowed_first_chars = f':_{string.ascii_letters}'
-    allowed_non_first_chars = f'{allowed_first_chars}{string.digits}-.'
-
-    current = at
-    ok = text[current] in allowed_first_chars
-    if ok:
-        current = at + 1
-        while current < len(text):
-            if text[current] not in allowed_non_first_chars:
-                break
-            current += 1
-    return text[at:current], current, ok
+    match = _NAME.match(text, at)
+    if match is None:
+        return '', at, False
+    current = match.end()
+    return text[at:current], current, True
 
 
 # See https://www.w3.org/TR/xml/#NT-AttValue
@@ -179,16 +447,11 @@ def parse_name(text: str, at: int) -> tuple[str, int, bool]:
 def parse_attribute_value(text: str, at: int) -> tuple[str, int, bool]:
     current = at
     ok = False
-    quote = text[at]
-    if quote in ['"', "'"]:
-        not_allowed_chars = f'<&{quote}'
-
-        current += 1
-        while current < len(text):
-            if text[current] in not_allowed_chars:
-                ok = text[current] == quote
-                current += 1
-                break
+    quote = text[at:at + 1]
+    if quote in _ATTRIBUTE_VALUE_RUN:
+        current = _ATTRIBUTE_VALUE_RUN[quote].match(text, at + 1).end()
+        if current < len(text):
+            ok = text[current] == quote
             current += 1
     return text[at:current], current, ok
 
@@ -202,7 +465,7 @@ def parse_attribute(text: str, at: int) -> tuple[Attribute, int, bool]:
     key, current, parsed = parse_name(text, current)
     if parsed:
         _, current, _ = parse_white_space(text, current)
-        if text[current] == '=':
+        if text[current:current + 1] == '=':
             current += 1
             _, current, _ = parse_white_space(text, current)
             value, current, ok = parse_attribute_value(text, current)
@@ -212,17 +475,21 @@ def parse_attribute(text: str, at: int) -> tuple[Attribute, int, bool]:
 
 
 # See https://www.w3.org/TR/xml/#NT-STag
-def parse_start_tag(text: str, at: int, parent: Element) -> tuple[Element, bool, int, bool]:
+# With a names table, element names and attribute keys are interned through it, so every
+# occurrence of a name shares one string object with the table.
+def parse_start_tag(text: str, at: int, parent: Element, names: dict[str, str] = None) -> tuple[Element, bool, int, bool]:
     element = None
 
     current = at
     ok = False
     empty_element = False
-    if text[current] == '<':
+    if text[current:current + 1] == '<':
         current += 1
         element_name, current, parsed = parse_name(text, current)
-        attributes: dict[str, str] = {}
+        attributes = None
         if parsed:
+            if names is not None:
+                element_name = names.setdefault(element_name, element_name)
             while True:
                 _, current, parsed = parse_white_space(text, current)
                 if not parsed:
@@ -232,79 +499,149 @@ def parse_start_tag(text: str, at: int, parent: Element) -> tuple[Element, bool,
                     break
 
                 # TODO(Compliance): verify that the attribute/namespace has not been already added
-                attributes[attribute.key] = attribute.value
+                if attributes is None:
+                    attributes = {}
+                key = attribute.key
+                if names is not None:
+                    key = names.setdefault(key, key)
+                attributes[key] = attribute.value
 
             _, current, _ = parse_white_space(text, current)
-            empty_element = text[current] == '/'
+            empty_element = text[current:current + 1] == '/'
             if empty_element:
                 current += 1
-            ok = text[current] == '>'
+            ok = text[current:current + 1] == '>'
             if ok:
                 current += 1
-                element = Element(parent=parent)
-                element.name = element_name
-                element.attributes = attributes
+                element = Element(name=element_name, attributes=attributes, parent=parent)
 
     return element, empty_element, current, ok
 
 
-# See https://www.w3.org/TR/xml/#NT-current
-def parse_content(text: str, at: int, current_element: Element, _recursive_call=False) -> tuple[int, bool]:
+# See https://www.w3.org/TR/xml/#NT-content
+# Nested elements are driven from an explicit stack of open elements rather than by
+# recursing through parse_element, so the nesting depth is bounded only by memory.
+# As before, the end tag of current_element itself is left for the caller.
+# With a references table, references that resolve_reference can decode are replaced by their
+# text, memoized in the table, and merged with the character data around them, so that a run
+# of text becomes a single str fragment. Unresolvable references stay Fragments.
+# With a spans table, the [start, end] offsets of every element created are recorded in it.
+def parse_content(text: str, at: int, current_element: Element, names: dict[str, str] = None,
+                  references: dict[str, str] = None, spans: dict[Element, list[int]] = None) -> tuple[int, bool]:
+    # Elements created below cannot have cached views yet
+    invalidate_views(current_element)
     current = at
     ok = True
+    end = len(text)
+    open_elements = [current_element]
+    element = current_element
+    # Text of the current element not appended yet, in resolving mode
+    pending = []
 
     while True:
-        data, current, parsed = parse_char_data(text, current)
-        if not parsed:
+        if current >= end:
             ok = False
             break
 
-        normalized_data = normalize_end_of_line(data)
-        if len(normalized_data) > 0:
-            current_element.fragments.append(Fragment(kind=FragmentType.CHAR_DATA, data=normalized_data))
+        if text[current] == '<':
+            if text[current + 1:current + 2] == '/':
+                if len(open_elements) == 1:
+                    break
+                current, ok = parse_end_tag(text, current, element)
+                if not ok:
+                    break
+                if pending:
+                    _append_pending(element, pending)
+                if spans is not None:
+                    spans[element][1] = current
+                open_elements.pop()
+                element = open_elements[-1]
+            else:
+                # TODO(Compliance): add support for CDSects, PIs and Comments
+                tag_start = current
+                child, empty_element, current, ok = parse_start_tag(text, current, element, names)
+                if not ok:
+                    break
+                if pending:
+                    _append_pending(element, pending)
+                if spans is not None:
+                    spans[child] = [tag_start, current]
+                element.fragments.append(child)
+                if not empty_element:
+                    open_elements.append(child)
+                    element = child
+        elif text[current] == '&':
+            reference, current, ok, kind = parse_reference(text, current)
+            if not ok:
+                break
+            if references is not None:
+                resolved = references.get(reference, _UNRESOLVED)
+                if resolved is _UNRESOLVED:
+                    resolved = references[reference] = resolve_reference(reference)
+                if resolved is not None:
+                    pending.append(resolved)
+                    continue
+                if pending:
+                    _append_pending(element, pending)
+            element.fragments.append(Fragment(kind=kind, data=reference))
         else:
-            child, new_current, parsed = parse_element(text, current, current_element)
-            if parsed:
-                current = new_current
-                current_element.fragments.append(Fragment(kind=FragmentType.ELEMENT, data=child))
+            data, current, ok = parse_char_data(text, current)
+            if not ok:
+                break
+            # End-of-line handling has already been applied to the whole input by parse_document
+            if references is not None:
+                pending.append(data)
             else:
-                entity, new_current, parsed, kind = parse_reference(text, current)
-                if parsed:
-                    current = new_current
-                    current_element.fragments.append(Fragment(kind=kind, data=entity))
-                    # TODO(Compliance): add support for CDSects, PIs and Comments
-
-        # TODO(Improvement): is the forward lookup required?
-        if current + 1 < len(text) and text[current:current + 2] == '</':
-            break
+                element.fragments.append(data)
+    if pending:
+        _append_pending(element, pending)
     return current, ok
 
 
+_UNRESOLVED = object()
+
+
+def _append_pending(element: Element, pending: list[str]):
+    element.fragments.append(pending[0] if len(pending) == 1 else ''.join(pending))
+    pending.clear()
+
+
 # See https://www.w3.org/TR/xml/#NT-ETag
 def parse_end_tag(text: str, at: int, current_element: Element) -> tuple[int, bool]:
     current = at
     ok = current + 1 < len(text) and text[current:current + 2] == '</'
+    # The expected name is compared in place, without slicing the name out of the text
+    name = current_element.name
+    if ok and text.startswith(name, current + 2):
+        current += 2 + len(name)
+        _, current, _ = parse_white_space(text, current)
+        if text[current:current + 1] == '>':
+            return current + 1, True
+        current = at
     if ok:
         current += 2
         element_name, current, ok = parse_name(text, current)
         ok = True if ok and current_element.name == element_name else False
         if ok:
             _, current, _ = parse_white_space(text, current)
-            ok = text[current] == '>'
+            ok = text[current:current + 1] == '>'
             if ok:
                 current += 1
     return current, ok
 
 
 # See https://www.w3.org/TR/xml/#NT-element
-def parse_element(text: str, at: int, parent: Element) -> [Element, int, bool]:
+def parse_element(text: str, at: int, parent: Element, names: dict[str, str] = None,
+                  references: dict[str, str] = None, spans: dict[Element, list[int]] = None) -> [Element, int, bool]:
     current = at
 
-    element, empty_element, current, ok = parse_start_tag(text, current, parent)
+    element, empty_element, current, ok = parse_start_tag(text, current, parent, names)
     if ok and not empty_element:
-        current, ok = parse_content(text, current, element)
+        current, ok = parse_content(text, current, element, names, references, spans)
         if ok:
             current, ok = parse_end_tag(text, current, element)
+    if ok and spans is not None:
+        spans[element] = [at, current]
 
     return element, current, ok
 
@@ -324,46 +661,466 @@ def parse_xml_declaration(text: str, at: int) -> tuple[Declaration, int, bool]:
             if parsed and attribute.key == 'version':
                 # Todo(Compliance): validate version value according to spec.
                 version = attribute.value
-                _, current, ok = parse_white_space(text, current)
-                if ok:
+                # White space is only required before a following pseudo-attribute
+                _, current, _ = parse_white_space(text, current)
 
-                    # Todo(Compliance): in case the standalone attribute is not declared,
-                    # - if an external entity reference is found, then it is assumed as false
-                    # - otherwise it is assumed as true
-                    standalone = None
-                    encoding = None
+                # Todo(Compliance): in case the standalone attribute is not declared,
+                # - if an external entity reference is found, then it is assumed as false
+                # - otherwise it is assumed as true
+                standalone = None
+                encoding = None
 
+                attribute, current, parsed = parse_attribute(text, current)
+                if parsed and attribute.key == 'encoding':
+                    encoding = attribute.value
+                    _, current, ok = parse_white_space(text, current)
                     attribute, current, parsed = parse_attribute(text, current)
-                    if parsed and attribute.key == 'encoding':
-                        encoding = attribute.value
-                        _, current, ok = parse_white_space(text, current)
-                        attribute, current, parsed = parse_attribute(text, current)
-                    if parsed and attribute.key == 'standalone' and attribute.value in {'yes', 'no'}:
-                        standalone = True if attribute.value == 'yes' else False
-                    _, current, _ = parse_white_space(text, current)
-                    ok = text[current:current + 2] == '?>'
-                    if ok:
-                        current += 2
-                        declaration = Declaration(version=version, encoding=encoding, standalone=standalone)
+                if parsed and attribute.key == 'standalone' and attribute.value in {'yes', 'no'}:
+                    standalone = True if attribute.value == 'yes' else False
+                _, current, _ = parse_white_space(text, current)
+                ok = text[current:current + 2] == '?>'
+                if ok:
+                    current += 2
+                    declaration = Declaration(version=version, encoding=encoding, standalone=standalone)
 
     return declaration, current, ok
 
 
 # See https://www.w3.org/TR/xml/#NT-document
 # TODO(Compliance): add support for prolog and Misc
-def parse_document(text: str, at=0) -> tuple[Document, int, bool]:
+# Names are interned through a table local to the call, unless one is passed in to be shared
+# between documents. Passing a references table, empty or shared, turns on resolving mode
+# (see parse_content). Passing an empty spans table records the span of every element in it,
+# in offsets into the normalized text, which the document keeps as its source for reparse.
+# Callers that have normalized the text themselves pass normalized to skip another pass.
+def parse_document(text: str, at=0, names: dict[str, str] = None, references: dict[str, str] = None,
+                   spans: dict[Element, list[int]] = None, normalized: bool = False) -> tuple[Document, int, bool]:
     document = None
+    if names is None:
+        names = {}
+
+    # Offsets returned by the productions refer to the normalized text
+    if not normalized:
+        if at:
+            at = len(normalize_end_of_line(text[:at]))
+        text = normalize_end_of_line(text)
 
     current = at
     # Todo(Compliance) parse prolog instead
     declaration, current, ok = parse_xml_declaration(text, current)
     _, current, _ = parse_white_space(text, current)
-    root, current, ok = parse_element(text, current, None)
+    root, current, ok = parse_element(text, current, None, names, references, spans)
     if ok:
-        document = Document(declaration, root)
+        document = Document(declaration, root) if spans is None else Document(declaration, root, text, spans)
     return document, current, ok
 
 
-def parse(xml: str) -> Document:
-    document, _, _ = parse_document(xml)
+def parse(xml: str, names: dict[str, str] = None, references: dict[str, str] = None,
+          spans: dict[Element, list[int]] = None) -> Document:
+    document, _, _ = parse_document(xml, names=names, references=references, spans=spans)
     return document
+
+
+# Like parse, but raises BadFormat where parsing stopped instead of returning None. The error
+# keeps the normalized text, so its line_column is only worked out if asked for.
+def parse_strict(xml: str, names: dict[str, str] = None, references: dict[str, str] = None,
+                 spans: dict[Element, list[int]] = None) -> Document:
+    text = normalize_end_of_line(xml)
+    document, current, ok = parse_document(text, names=names, references=references, spans=spans, normalized=True)
+    if not ok:
+        raise BadFormat('malformed document', current, text)
+    return document
+
+
+# Applies an edit replacing document.source[edit_start:edit_end] with new_text to a document
+# parsed with a spans table, re-parsing only the smallest element whose span encloses the
+# edit, or the next enclosing one for as long as the edited text does not parse as an element
+# ending where the old one did. Spans after the edit are shifted, and the whole document is
+# parsed again only if no element can absorb the edit. Returns the updated document, or None,
+# leaving it untouched, when the edited text is not well-formed. Offsets refer to the
+# normalized source, and the tree must not have been changed since it was parsed. Text is
+# re-parsed without resolving references.
+def reparse(document: Document, edit_start: int, edit_end: int, new_text: str) -> Document:
+    spans = document.spans
+    if spans is None:
+        raise ValueError('the document was not parsed with a spans table')
+    source = document.source
+    if not 0 <= edit_start <= edit_end <= len(source):
+        raise ValueError(f'invalid edit range {edit_start}:{edit_end}')
+    new_text = normalize_end_of_line(new_text)
+    text = source[:edit_start] + new_text + source[edit_end:]
+    delta = len(new_text) - (edit_end - edit_start)
+
+    element = _enclosing_element(document.root, spans, edit_start, edit_end)
+    while element is not None:
+        start, end = spans[element]
+        replacement_spans = {}
+        replacement, current, ok = parse_element(text, start, element.parent, {}, None, replacement_spans)
+        if ok and current == end + delta:
+            _replace_subtree(document, element, replacement, replacement_spans, end, delta)
+            document.source = text
+            return document
+        element = element.parent
+
+    replacement_spans = {}
+    replacement, _, ok = parse_document(text, spans=replacement_spans)
+    if not ok:
+        return None
+    document.declaration = replacement.declaration
+    document.root = replacement.root
+    document.source = text
+    document.spans = replacement_spans
+    document._index = None
+    return document
+
+
+# The innermost element whose span strictly contains the edit, found by binary search
+# among the children at each level, or None when not even the root does
+def _enclosing_element(root: Element, spans: dict[Element, list[int]], edit_start: int, edit_end: int) -> Element:
+    start, end = spans[root]
+    if not (start < edit_start and edit_end < end):
+        return None
+    element = root
+    while True:
+        children = element.children
+        low, high = 0, len(children)
+        while low < high:
+            middle = (low + high) // 2
+            if spans[children[middle]][0] < edit_start:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return element
+        start, end = spans[children[low - 1]]
+        if edit_end >= end:
+            return element
+        element = children[low - 1]
+
+
+def _replace_subtree(document: Document, old: Element, new: Element, new_spans: dict[Element, list[int]], end: int, delta: int):
+    spans = document.spans
+    for element in _iterate_subtree(old):
+        del spans[element]
+    if delta:
+        for span in spans.values():
+            if span[0] >= end:
+                span[0] += delta
+            if span[1] >= end:
+                span[1] += delta
+    spans.update(new_spans)
+
+    parent = old.parent
+    if parent is None:
+        document.root = new
+    else:
+        parent.fragments[parent.fragments.index(old)] = new
+        # The text of the parent is unchanged, and its cached children only need the swap
+        children = parent._children
+        if children is not None:
+            list.__setitem__(children, children.index(old), new)
+    old.parent = None
+    document._index = None
+
+
+# UTF-32 marks go first: the UTF-32-LE mark starts with the UTF-16-LE one
+_BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+_DECLARATION_SCAN_LIMIT = 1024
+
+
+# See https://www.w3.org/TR/xml/#sec-guessing
+# Returns the encoding of data and the length of its byte order mark. Unless final, None is
+# returned when more bytes are needed to tell.
+def detect_encoding(data, final: bool = True) -> tuple[str, int]:
+    head = bytes(data[:_DECLARATION_SCAN_LIMIT])
+    if not final and len(head) < 5 and (len(head) < 4 or b'<?xml'.startswith(head)):
+        return None
+    for mark, encoding in _BYTE_ORDER_MARKS:
+        if head.startswith(mark):
+            return encoding, len(mark)
+    if head.startswith(b'<\x00?\x00'):
+        return 'utf-16-le', 0
+    if head.startswith(b'\x00<\x00?'):
+        return 'utf-16-be', 0
+
+    encoding = 'utf-8'
+    if head.startswith(b'<?xml'):
+        end = head.find(b'?>')
+        if end < 0 and not final and len(head) < _DECLARATION_SCAN_LIMIT:
+            return None
+        if end >= 0:
+            declaration, _, ok = parse_xml_declaration(head[:end + 2].decode('latin-1'), 0)
+            if ok and declaration.encoding:
+                encoding = declaration.encoding
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        raise BadFormat(f'unknown encoding {encoding!r}', 0) from None
+    return encoding, 0
+
+
+# Parses an encoded document held in any buffer (bytes, bytearray, memoryview, mmap). The
+# buffer is decoded in one pass straight into the text the productions run on, so no
+# intermediate copy of the raw input is made.
+def parse_bytes(data, names: dict[str, str] = None, references: dict[str, str] = None) -> Document:
+    return parse(decode_bytes(data), names, references)
+
+
+def decode_bytes(data) -> str:
+    encoding, mark_length = detect_encoding(data)
+    with memoryview(data) as view, view[mark_length:] as body:
+        try:
+            return str(body, encoding)
+        except UnicodeDecodeError as error:
+            raise BadFormat(f'cannot decode input as {encoding}', mark_length + error.start) from None
+
+
+# Memory-maps the file at path, so the raw bytes are read through the page cache instead of
+# being copied onto the heap before decoding.
+def parse_file(path, names: dict[str, str] = None, references: dict[str, str] = None) -> Document:
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return parse('')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return parse_bytes(mapped, names, references)
+
+
+# Matches a tag up to, but excluding, its closing '>'. Quoted attribute values may
+# contain '>', so they are skipped as a whole.
+_TAG_BODY = re.compile('<[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*')
+_EVENTS = frozenset({'start', 'end'})
+
+
+# Push parser: data is fed in arbitrary pieces and (event, element) pairs are collected
+# for read_events as soon as the corresponding tags are complete. Input is buffered until
+# the token at the current position can be complete, then the same parse_* functions used
+# by parse_document run over the buffer, so a piece may end anywhere, including inside a
+# name, an attribute value or a reference. Bytes are decoded with the encoding named by
+# their byte order mark or XML declaration.
+class FeedParser:
+    def __init__(self, events=('end',)):
+        if not _EVENTS.issuperset(events):
+            raise ValueError(f'unknown events: {", ".join(sorted(set(events) - _EVENTS))}')
+        self.events = frozenset(events)
+        self.declaration = None
+        self.root = None
+        self._decoder = None
+        self._undecoded = b''
+        self._normalizer = EndOfLineNormalizer()
+        self._buffer = ''
+        self._at = 0
+        self._offset = 0
+        self._chunks = []
+        # Characters one of which must arrive before the buffered tail can be parsed further
+        self._stalled_on = None
+        self._open_elements = []
+        self._names = {}
+        self._pending_events = []
+        self._finished = False
+
+    def feed(self, data: Union[str, bytes]):
+        if self._finished:
+            return
+        if not isinstance(data, str):
+            data = self._decode(data, final=False)
+        data = self._normalizer.normalize(data)
+        self._chunks.append(data)
+        if self._stalled_on is None or any(char in data for char in self._stalled_on):
+            self._parse(final=False)
+
+    def close(self) -> Document:
+        data = self._decode(b'', final=True) if self._decoder is not None or self._undecoded else ''
+        self._chunks.append(self._normalizer.normalize(data, final=True))
+        if not self._finished:
+            self._parse(final=True)
+        if not self._finished:
+            raise BadFormat('unexpected end of input', self._offset + len(self._buffer))
+        return Document(self.declaration, self.root)
+
+    def _decode(self, data: bytes, final: bool) -> str:
+        if self._decoder is None:
+            self._undecoded += data
+            detected = detect_encoding(self._undecoded, final)
+            if detected is None:
+                return ''
+            encoding, mark_length = detected
+            self._decoder = codecs.getincrementaldecoder(encoding)()
+            data, self._undecoded = self._undecoded[mark_length:], b''
+        return self._decoder.decode(data, final)
+
+    def read_events(self):
+        events, self._pending_events = self._pending_events, []
+        yield from events
+
+    def _parse(self, final: bool):
+        text = self._buffer[self._at:] + ''.join(self._chunks)
+        self._offset += self._at
+        self._chunks.clear()
+
+        open_elements = self._open_elements
+        events = self._pending_events
+        report_start = 'start' in self.events
+        report_end = 'end' in self.events
+        stalled_on = None
+        current = 0
+        end = len(text)
+        # Productions are tried optimistically: none of them succeeds on a token cut short by
+        # the end of the buffer, so only a failure needs to check whether more input may help
+        while current < end and not self._finished:
+            at = current
+            char = text[current]
+            if char == '<':
+                if text[current + 1:current + 2] == '/':
+                    if not open_elements:
+                        raise BadFormat('end tag before the root element', self._offset + at)
+                    element = open_elements[-1]
+                    current, ok = parse_end_tag(text, current, element)
+                    if not ok:
+                        if not final and _tag_may_continue(text, at):
+                            current, stalled_on = at, '>'
+                            break
+                        raise BadFormat(f'expected </{element.name}>', self._offset + at)
+                    open_elements.pop()
+                    if report_end:
+                        events.append(('end', element))
+                    self._finished = not open_elements
+                elif self._offset + current == 0 and text.startswith('<?xml', current):
+                    self.declaration, current, ok = parse_xml_declaration(text, current)
+                    if not ok:
+                        if not final and _tag_may_continue(text, at):
+                            current, stalled_on = at, '>'
+                            break
+                        raise BadFormat('malformed XML declaration', self._offset + at)
+                else:
+                    parent = open_elements[-1] if open_elements else None
+                    element, empty_element, current, ok = parse_start_tag(text, current, parent, self._names)
+                    if not ok:
+                        if not final and _tag_may_continue(text, at):
+                            current, stalled_on = at, '>'
+                            break
+                        raise BadFormat('malformed start tag', self._offset + at)
+                    if parent is None:
+                        self.root = element
+                    else:
+                        parent.fragments.append(element)
+                        parent._children = None
+                    if report_start:
+                        events.append(('start', element))
+                    if not empty_element:
+                        open_elements.append(element)
+                    else:
+                        if report_end:
+                            events.append(('end', element))
+                        self._finished = parent is None
+            elif not open_elements:
+                # TODO(Compliance): add support for prolog and Misc
+                _, current, parsed = parse_white_space(text, current)
+                if not parsed:
+                    raise BadFormat('expected the root element', self._offset + at)
+            elif char == '&':
+                reference, current, ok, kind = parse_reference(text, current)
+                if not ok:
+                    if not final and text.find(';', at) < 0:
+                        current, stalled_on = at, ';'
+                        break
+                    raise BadFormat('malformed reference', self._offset + at)
+                open_elements[-1].fragments.append(Fragment(kind=kind, data=reference))
+                open_elements[-1]._text = None
+            else:
+                data, current, ok = parse_char_data(text, current)
+                if not ok:
+                    raise BadFormat("']]>' in character data", self._offset + current)
+                if current >= end and not final:
+                    current, stalled_on = at, '<&'
+                    break
+                open_elements[-1].fragments.append(data)
+                open_elements[-1]._text = None
+
+        self._buffer = text
+        self._at = current
+        self._stalled_on = stalled_on
+
+
+def _tag_may_continue(text: str, at: int) -> bool:
+    tag_end = _TAG_BODY.match(text, at).end()
+    return tag_end >= len(text) or text[tag_end] != '>'
+
+
+# Detaches a finished element, together with the siblings preceding it, from its parent
+def _detach(element: Element):
+    parent = element.parent
+    if parent is None:
+        return
+    fragments = parent.fragments
+    # Earlier siblings have normally been detached already, so the element is near the front
+    for index in range(len(fragments)):
+        if fragments[index] is element:
+            del fragments[:index + 1]
+            invalidate_views(parent)
+            break
+
+
+# Reads fileobj in chunks of chunk_size and yields (event, element) pairs as soon as
+# the corresponding tags are complete. Elements are complete when their 'end' event
+# is reported. With tag, only events for elements of that name are reported. With
+# clear, finished records are detached from their parent, along with the preceding
+# siblings, once the consumer resumes the generator, so that memory stays flat over long
+# lists of records. Records are the outermost elements named tag, or without tag the
+# children of the root, so that every record arrives with its whole content.
+def iterparse(fileobj, events=('start', 'end'), *, tag: str = None, clear: bool = False, chunk_size: int = 64 * 1024):
+    parser = FeedParser(events)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        yield from _report_events(parser, tag, clear)
+    parser.close()
+    yield from _report_events(parser, tag, clear)
+
+
+# Asynchronous counterpart of iterparse consuming an asyncio.StreamReader. Whatever data is
+# available is parsed right away, so an element is reported as soon as its end tag arrives.
+async def aiterparse(reader, events=('end',), *, tag: str = None, clear: bool = False, chunk_size: int = 64 * 1024):
+    parser = FeedParser(events)
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        for event in _report_events(parser, tag, clear):
+            yield event
+    parser.close()
+    for event in _report_events(parser, tag, clear):
+        yield event
+
+
+def _report_events(parser: FeedParser, tag: str, clear: bool):
+    for event, element in parser.read_events():
+        if tag is None or element.name == tag:
+            yield event, element
+            if clear and event == 'end' and _is_record(element, tag):
+                _detach(element)
+
+
+# Whether element is one of the records iterparse clears: a child of the root, or with tag an
+# element of that name not nested in another one
+def _is_record(element: Element, tag: str) -> bool:
+    parent = element.parent
+    if tag is None:
+        return parent is not None and parent.parent is None
+    while parent is not None:
+        if parent.name == tag:
+            return False
+        parent = parent.parent
+    return True
+
+
+# Kept at the end: e4.parallel builds on the definitions above
+from .parallel import parse_many, parse_split  # noqa: E402
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+from . import Document, Declaration, Element, Fragment, FragmentType, parse_file
+
+import array
+import hashlib
+import marshal
+import os
+
+
+# A cached document is _MAGIC followed by one marshal record:
+#   (format version, source key, declaration, strings, typecode, structure, attributes)
+# strings holds every distinct name and text once. structure is the bytes of an array of
+# opcodes and operands: _START name attributes, where attributes is 0 or 1 + an index into the
+# attributes list, _END, and _TEXT, _CHAR_REFERENCE or _ENTITY_REFERENCE followed by a string
+# index. The array uses the smallest typecode that holds every operand.
+# marshal is only meant for data we wrote ourselves, which is the case for a cache.
+_MAGIC = b'E4CACHE\0'
+_FORMAT_VERSION = 1
+
+_START = 0
+_END = 1
+_TEXT = 2
+_CHAR_REFERENCE = 3
+_ENTITY_REFERENCE = 4
+
+
+def encode(document: Document, key: tuple = None) -> bytes:
+    strings = []
+    string_indices = {}
+    structure = array.array('I')
+    write = structure.append
+    attributes = []
+
+    def intern(string: str) -> int:
+        index = string_indices.get(string)
+        if index is None:
+            index = string_indices[string] = len(strings)
+            strings.append(string)
+        return index
+
+    stack = [iter((document.root,))]
+    while stack:
+        for fragment in stack[-1]:
+            if isinstance(fragment, Element):
+                write(_START)
+                write(intern(fragment.name))
+                if fragment._attributes:
+                    attributes.append(dict(fragment._attributes))
+                    write(len(attributes))
+                else:
+                    write(0)
+                stack.append(iter(fragment.fragments))
+                break
+            elif isinstance(fragment, str):
+                write(_TEXT)
+                write(intern(fragment))
+            else:
+                write(_CHAR_REFERENCE if fragment.kind == FragmentType.CHAR_REFERENCE else _ENTITY_REFERENCE)
+                write(intern(fragment.data))
+        else:
+            stack.pop()
+            if stack:
+                write(_END)
+
+    declaration = document.declaration
+    if declaration is not None:
+        declaration = (declaration.version, declaration.encoding, declaration.standalone)
+    largest = max(len(strings), len(attributes) + 1)
+    typecode = 'B' if largest <= 0xFF else 'H' if largest <= 0xFFFF else 'I'
+    if typecode != 'I':
+        structure = array.array(typecode, structure)
+    return _MAGIC + marshal.dumps((_FORMAT_VERSION, key, declaration, strings, typecode, structure.tobytes(), attributes))
+
+
+# Raises ValueError when data is not a cache of this format version
+def decode(data: bytes) -> Document:
+    return _document_from_record(_load_record(data))
+
+
+def _document_from_record(record: tuple) -> Document:
+    _, _, declaration, strings, typecode, structure, attributes = record
+    if declaration is not None:
+        declaration = Declaration(*declaration)
+
+    try:
+        codes = array.array(typecode)
+        codes.frombytes(structure)
+        root = _build(strings, iter(codes), attributes)
+    except (IndexError, AttributeError, StopIteration, TypeError, ValueError):
+        raise ValueError('corrupt e4 cache') from None
+    return Document(declaration, root)
+
+
+def _build(strings: list[str], codes, attributes: list[dict]) -> Element:
+    root = None
+    open_elements = []
+    element = None
+    for code in codes:
+        if code == _TEXT:
+            element.fragments.append(strings[next(codes)])
+        elif code == _START:
+            name = strings[next(codes)]
+            attributes_index = next(codes)
+            child = Element(name=name, attributes=attributes[attributes_index - 1] if attributes_index else None,
+                            parent=element)
+            if element is None:
+                root = child
+            else:
+                element.fragments.append(child)
+            open_elements.append(child)
+            element = child
+        elif code == _END:
+            open_elements.pop()
+            element = open_elements[-1] if open_elements else None
+        else:
+            kind = FragmentType.CHAR_REFERENCE if code == _CHAR_REFERENCE else FragmentType.ENTITY_REFERENCE
+            element.fragments.append(Fragment(kind=kind, data=strings[next(codes)]))
+    if root is None or open_elements:
+        raise ValueError('corrupt e4 cache')
+    return root
+
+
+def _load_record(data: bytes) -> tuple:
+    if data[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('not an e4 cache')
+    try:
+        record = marshal.loads(memoryview(data)[len(_MAGIC):])
+    except (EOFError, TypeError, ValueError):
+        raise ValueError('corrupt e4 cache') from None
+    if not isinstance(record, tuple) or len(record) != 7 or record[0] != _FORMAT_VERSION:
+        raise ValueError('unsupported e4 cache format')
+    return record
+
+
+def dump_cache(document: Document, path, key: tuple = None):
+    # Written aside and renamed, so a concurrent reader never sees half a cache
+    temporary = f'{os.fspath(path)}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'wb') as file:
+            file.write(encode(document, key))
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def load_cache(path) -> Document:
+    with open(path, 'rb') as file:
+        return decode(file.read())
+
+
+# Identifies the contents of the file at path: its size and modification time, or with
+# by_hash its size and SHA-256, which survives copies that do not preserve times
+def source_key(path, by_hash: bool = False) -> tuple:
+    status = os.stat(path)
+    if not by_hash:
+        return 'mtime', status.st_size, status.st_mtime_ns
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return 'sha256', status.st_size, digest.hexdigest()
+
+
+# Parses the file at path through a cache stored next to it, at path + '.e4c' unless
+# cache_path says otherwise. The cache is used only when its key matches the source file,
+# and is rewritten otherwise, including when it is missing, corrupt or of another format.
+# Documents that fail to parse are not cached, and None is returned as with parse_file.
+# A cache that cannot be written, in a missing or read-only directory, is only skipped.
+def parse_cached(path, cache_path=None, by_hash: bool = False) -> Document:
+    if cache_path is None:
+        cache_path = f'{os.fspath(path)}.e4c'
+    key = source_key(path, by_hash)
+    try:
+        with open(cache_path, 'rb') as file:
+            record = _load_record(file.read())
+        if record[1] == key:
+            return _document_from_record(record)
+    except (OSError, ValueError):
+        pass
+
+    document = parse_file(path)
+    if document is not None:
+        try:
+            dump_cache(document, cache_path, key)
+        except OSError:
+            pass
+    return document
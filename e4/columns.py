@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from . import normalize_end_of_line, resolve_reference
+from .tokens import TokenKind, iterate_spans
+
+from typing import Callable, Union
+
+import array
+
+
+# Element types for the typed columns kept in arrays; other converters give lists
+_ARRAY_TYPECODES = {int: 'q', float: 'd'}
+
+
+# Extracts one row per element named record into a column per entry of fields, filling the
+# columns as the tokenizer scans xml, without building a tree or storing the token stream. A field is '@key' for an attribute of
+# the record, the name of a child element for the text of the first such child, or '.' for
+# the record's own text. As with Element.text, only text directly inside the element counts,
+# and references in it are resolved where resolve_reference can.
+# Records nested in records are not rows of their own.
+# converters maps columns to functions applied to every present value; int and float give
+# array('q') and array('d') columns, anything else a list. Missing values are None in lists,
+# take the value from defaults, and otherwise raise ValueError in arrays. With numpy, every
+# column is returned as a NumPy array instead.
+def extract_columns(xml: str, record: str, fields: dict[str, str], converters: dict[str, Callable] = None,
+                    defaults: dict[str, object] = None, numpy: bool = False) -> dict[str, Union[list, array.array]]:
+    converters = converters or {}
+    defaults = defaults or {}
+    attribute_keys = {field[1:] for field in fields.values() if field.startswith('@')}
+    child_names = {field for field in fields.values() if field != '.' and not field.startswith('@')}
+    values = {column: [] for column in fields}
+    START, END, ATTRIBUTE_NAME, ATTRIBUTE_VALUE, TEXT = map(int, (TokenKind.START, TokenKind.END, TokenKind.ATTRIBUTE_NAME,
+                                                                 TokenKind.ATTRIBUTE_VALUE, TokenKind.TEXT))
+
+    text = normalize_end_of_line(xml)
+    depth = 0
+    # Depth of the record being read, and of the child whose text is being collected
+    record_depth = None
+    child_depth = None
+    # Per record: text pieces of fields by field, and the pieces of its own text
+    found = None
+    pieces = None
+    own_pieces = None
+    attribute_key = None
+    for kind, start, end in iterate_spans(text):
+        if kind == START:
+            depth += 1
+            if record_depth is None:
+                if end - start == len(record) and text.startswith(record, start):
+                    record_depth = depth
+                    found = {}
+                    own_pieces = []
+            elif depth == record_depth + 1 and child_depth is None and child_names:
+                name = text[start:end]
+                if name in child_names and name not in found:
+                    child_depth = depth
+                    pieces = found[name] = []
+        elif kind == END:
+            if depth == child_depth:
+                child_depth = None
+            elif depth == record_depth:
+                for column, field in fields.items():
+                    if field == '.':
+                        value = ''.join(own_pieces)
+                    elif field.startswith('@'):
+                        value = found.get(field)
+                    else:
+                        value = ''.join(found[field]) if field in found else None
+                    values[column].append(value)
+                record_depth = None
+            depth -= 1
+        elif record_depth is None:
+            continue
+        elif kind == ATTRIBUTE_NAME:
+            attribute_key = text[start:end] if depth == record_depth else None
+        elif kind == ATTRIBUTE_VALUE:
+            if attribute_key in attribute_keys:
+                found['@' + attribute_key] = text[start:end]
+        elif depth == child_depth or depth == record_depth:
+            value = text[start:end]
+            if kind != TEXT:
+                resolved = resolve_reference(value)
+                value = resolved if resolved is not None else value
+            if depth == child_depth:
+                pieces.append(value)
+            else:
+                own_pieces.append(value)
+
+    columns = {column: _convert(column, column_values, converters.get(column), defaults)
+               for column, column_values in values.items()}
+    if numpy:
+        import numpy as np
+        return {column: np.asarray(column_values) for column, column_values in columns.items()}
+    return columns
+
+
+def _convert(column: str, values: list, converter: Callable, defaults: dict) -> Union[list, array.array]:
+    default = defaults.get(column)
+    if converter is None:
+        return [value if value is not None else default for value in values]
+    converted = [converter(value) if value is not None else default for value in values]
+    typecode = _ARRAY_TYPECODES.get(converter)
+    if typecode is None:
+        return converted
+    if None in converted:
+        raise ValueError(f'column {column!r} has no value in row {converted.index(None)} and no default')
+    return array.array(typecode, converted)
@@ -1,33 +1,227 @@
 from __future__ import annotations
 
-from ..e4 import Element, Fragment, FragmentType
+from . import Element, Fragment, invalidate_views, index_of
 
-from typing import Callable
+from typing import Callable, Iterable, Union
 
 
+# Appending keeps a cached children list valid, so it does not have to be rebuilt
 def append_child(parent: Element, child: Element):
-    insert_child(parent, len(parent.fragments), child)
+    parent.fragments.append(child)
+    if parent._children is not None:
+        list.append(parent._children, child)
+    child.parent = parent
+    document_index = index_of(parent)
+    if document_index is not None:
+        document_index.insert([child])
 
 
 def insert_child(parent: Element, index: int, child: Element):
-    parent.fragments.insert(index, Fragment(kind=FragmentType.ELEMENT, data=child))
+    parent.fragments.insert(index, child)
+    parent._children = None
     child.parent = parent
+    document_index = index_of(parent)
+    if document_index is not None:
+        document_index.insert([child])
+
+
+def remove_child(parent: Element, child: Element):
+    fragments = parent.fragments
+    for index, fragment in enumerate(fragments):
+        if fragment is child:
+            remove_fragment(parent, index)
+            return
+    raise ValueError(f'<{child.name}> is not a child of <{parent.name}>')
 
 
 def append_text(parent: Element, text: str):
-    insert_text(parent, len(parent.fragments), text)
+    parent.fragments.append(text)
+    if parent._text is not None:
+        list.append(parent._text, text)
 
 
 def insert_text(parent: Element, index: int, text: str):
-    parent.fragments.insert(index, Fragment(kind=FragmentType.CHAR_DATA, data=text))
+    parent.fragments.insert(index, text)
+    parent._text = None
+
+
+# Appends every node of nodes to parent in one go, looking the document index up once.
+# Adjacent strings, including one already ending parent, are merged into a single fragment.
+def extend_children(parent: Element, nodes: Iterable[Union[str, Element, Fragment]]):
+    fragments = parent.fragments
+    # Text waiting to be joined, starting with the last fragment when it is text
+    pending = [fragments.pop()] if fragments and isinstance(fragments[-1], str) else []
+    added = []
+    for node in nodes:
+        if isinstance(node, str):
+            pending.append(node)
+            continue
+        if pending:
+            fragments.append(''.join(pending))
+            pending.clear()
+        fragments.append(node)
+        if isinstance(node, Element):
+            node.parent = parent
+            added.append(node)
+    if pending:
+        fragments.append(''.join(pending))
+    invalidate_views(parent)
+    document_index = index_of(parent)
+    if document_index is not None and added:
+        document_index.insert(added)
+
+
+def remove_fragment(parent: Element, index: int) -> Union[str, Element, Fragment]:
+    fragment = parent.fragments.pop(index)
+    invalidate_views(parent)
+    if isinstance(fragment, Element):
+        document_index = index_of(parent)
+        if document_index is not None:
+            document_index.remove(fragment)
+        fragment.parent = None
+    return fragment
 
 
-def find_first(node: Element, condition: Callable[[Fragment], bool]) -> Fragment:
+# Both go through the cached children list, so repeated calls allocate nothing
+def child_count(parent: Element) -> int:
+    return len(parent.children)
+
+
+def nth_child(parent: Element, index: int) -> Element:
+    return parent.children[index]
+
+
+# condition is called with each fragment of node as stored: an Element, a Fragment for a
+# reference, or a plain str for character data, which has no kind or data attribute. Conditions
+# on the kind of fragment should go through fragment_kind.
+def find_first(node: Element, condition: Callable[[Union[str, Element, Fragment]], bool]) -> Union[str, Element, Fragment]:
     first, _ = find_first_with_index(node, condition)
     return first
 
 
-def find_first_with_index(node: Element, condition: Callable[[Fragment], bool]) -> tuple[Fragment, int]:
+def find_first_with_index(node: Element, condition: Callable[[Union[str, Element, Fragment]], bool]) -> tuple[Union[str, Element, Fragment], int]:
     for index, fragment in enumerate(node.fragments):
         if condition(fragment):
             return fragment, index
+    return None, -1
+
+
+# Copies the subtree of element without going through copy.deepcopy. Strings are shared, and
+# elements without attributes stay without a dict; the copy has no parent.
+def clone(element: Element) -> Element:
+    root = Element(name=element.name, attributes=_copy_attributes(element._attributes))
+    stack = [(element, root)]
+    while stack:
+        original, copy = stack.pop()
+        fragments = copy.fragments
+        for fragment in original.fragments:
+            if isinstance(fragment, str):
+                fragments.append(fragment)
+            elif isinstance(fragment, Element):
+                child = Element(name=fragment.name, attributes=_copy_attributes(fragment._attributes), parent=copy)
+                fragments.append(child)
+                stack.append((fragment, child))
+            else:
+                fragments.append(Fragment(kind=fragment.kind, data=fragment.data))
+    return root
+
+
+def _copy_attributes(attributes: dict[str, str]) -> dict[str, str]:
+    return dict(attributes) if attributes else None
+
+
+# Builds a new tree from start/end/data calls in document order, as when generating large
+# documents. Text passed to data is collected and joined once the element gets a child or
+# ends, so an element never holds adjacent strings. Attributes are copied, as ElementTree
+# does, so one dict can be passed for many elements; elements without attributes get no
+# dict until their attributes are accessed, as parsed ones. Cached children and text views
+# of elements being built follow every addition, though text shows in them once joined.
+class TreeBuilder:
+    __slots__ = ('root', '_open', '_pending')
+
+    def __init__(self):
+        self.root = None
+        self._open = []
+        self._pending = []
+
+    def start(self, name: str, attributes: dict[str, str] = None) -> Element:
+        element = self._new_element(name, attributes)
+        self._open.append(element)
+        return element
+
+    def end(self, name: str = None) -> Element:
+        if not self._open:
+            raise ValueError('no element is open')
+        # Checked before anything changes, so the builder stays usable after the error
+        element = self._open[-1]
+        if name is not None and name != element.name:
+            raise ValueError(f'</{name}> does not close <{element.name}>')
+        self._flush()
+        return self._open.pop()
+
+    def data(self, text: str):
+        if not self._open:
+            raise ValueError('text outside of the root element')
+        if text:
+            self._pending.append(text)
+
+    # Adds an element holding only text, which stays closed
+    def leaf(self, name: str, attributes: dict[str, str] = None, text: str = '') -> Element:
+        element = self._new_element(name, attributes)
+        if text:
+            element.fragments.append(text)
+        return element
+
+    # Adds existing nodes to the open element: strings are merged with the surrounding text,
+    # and elements, such as clones of a template, are adopted as they are
+    def extend(self, nodes: Iterable[Union[str, Element, Fragment]]):
+        if not self._open:
+            raise ValueError('no element is open')
+        parent = self._open[-1]
+        fragments = parent.fragments
+        pending = self._pending
+        for node in nodes:
+            if isinstance(node, str):
+                if node:
+                    pending.append(node)
+                continue
+            self._flush()
+            fragments.append(node)
+            if isinstance(node, Element):
+                node.parent = parent
+                if parent._children is not None:
+                    list.append(parent._children, node)
+            elif parent._text is not None:
+                list.append(parent._text, node.data)
+
+    def close(self) -> Element:
+        if self._open:
+            raise ValueError(f'<{self._open[-1].name}> is not closed')
+        if self.root is None:
+            raise ValueError('no root element')
+        return self.root
+
+    def _new_element(self, name: str, attributes: dict[str, str]) -> Element:
+        element = Element(name=name, attributes=dict(attributes) if attributes else None)
+        if self._open:
+            self._flush()
+            parent = self._open[-1]
+            element.parent = parent
+            parent.fragments.append(element)
+            if parent._children is not None:
+                list.append(parent._children, element)
+        elif self.root is None:
+            self.root = element
+        else:
+            raise ValueError('only one root element is allowed')
+        return element
+
+    def _flush(self):
+        pending = self._pending
+        if pending:
+            element = self._open[-1]
+            text = pending[0] if len(pending) == 1 else ''.join(pending)
+            element.fragments.append(text)
+            if element._text is not None:
+                list.append(element._text, text)
+            pending.clear()
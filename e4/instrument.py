@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import contextlib
+import functools
+import sys
+import time
+
+from typing import Iterator
+
+
+# Per production: the positions of the offset reached and of the success flag in its result
+_PRODUCTIONS = {
+    'parse_white_space': (1, 2),
+    'parse_char_data': (1, 2),
+    'parse_entity_reference': (1, 2),
+    'parse_char_reference': (1, 2),
+    'parse_reference': (1, 2),
+    'parse_name': (1, 2),
+    'parse_attribute_value': (1, 2),
+    'parse_attribute': (1, 2),
+    'parse_start_tag': (2, 3),
+    'parse_content': (0, 1),
+    'parse_end_tag': (0, 1),
+    'parse_element': (1, 2),
+    'parse_xml_declaration': (1, 2),
+    'parse_document': (1, 2),
+}
+
+
+class Counters:
+    __slots__ = ('calls', 'characters', 'seconds', 'own_seconds', 'backtracks')
+
+    def __init__(self):
+        self.calls = 0
+        # Characters consumed by successful calls
+        self.characters = 0
+        # Time including, and excluding, the productions called from this one
+        self.seconds = 0.0
+        self.own_seconds = 0.0
+        # Calls that did not match, leaving the caller to try an alternative or to treat an
+        # optional production as absent, as parse_reference and parse_white_space do
+        self.backtracks = 0
+
+
+class Profile:
+    def __init__(self):
+        self.counters = {name: Counters() for name in _PRODUCTIONS}
+        # Time spent in nested productions, one entry per active call
+        self._nested = []
+
+    def as_dict(self) -> dict[str, dict]:
+        return {name: {slot: getattr(counters, slot) for slot in Counters.__slots__}
+                for name, counters in self.counters.items() if counters.calls}
+
+    # Productions sorted by own time, the first place to look when a document parses slowly
+    def report(self) -> str:
+        rows = sorted(self.as_dict().items(), key=lambda item: item[1]['own_seconds'], reverse=True)
+        lines = [f'{"production":24} {"calls":>10} {"characters":>12} {"total ms":>10} {"own ms":>10} {"backtracks":>10}']
+        for name, row in rows:
+            lines.append(f'{name:24} {row["calls"]:10} {row["characters"]:12} {row["seconds"] * 1000:10.3f} '
+                         f'{row["own_seconds"] * 1000:10.3f} {row["backtracks"]:10}')
+        return '\n'.join(lines)
+
+    def _wrap(self, name: str, production):
+        counters = self.counters[name]
+        current_index, ok_index = _PRODUCTIONS[name]
+        nested = self._nested
+        clock = time.perf_counter
+
+        @functools.wraps(production)
+        def instrumented(text, at=0, *arguments, **keywords):
+            nested.append(0.0)
+            start = clock()
+            try:
+                result = production(text, at, *arguments, **keywords)
+            finally:
+                elapsed = clock() - start
+                inner = nested.pop()
+                if nested:
+                    nested[-1] += elapsed
+                counters.calls += 1
+                counters.seconds += elapsed
+                counters.own_seconds += elapsed - inner
+            if result[ok_index]:
+                counters.characters += result[current_index] - at
+            else:
+                counters.backtracks += 1
+            return result
+        return instrumented
+
+
+_active: Profile = None
+
+
+# Replaces the productions in the e4 module with counting wrappers for the duration of the
+# block. The productions call each other through the module globals, so every nested call
+# is recorded; outside the block the original functions are in place and nothing is paid.
+# Names imported from e4 into other modules before the block keep the originals.
+@contextlib.contextmanager
+def instrument() -> Iterator[Profile]:
+    global _active
+    if _active is not None:
+        raise RuntimeError('instrumentation is already active')
+    module = sys.modules['e4']
+    originals = {name: getattr(module, name) for name in _PRODUCTIONS}
+    profile = _active = Profile()
+    try:
+        for name, production in originals.items():
+            setattr(module, name, profile._wrap(name, production))
+        yield profile
+    finally:
+        for name, production in originals.items():
+            setattr(module, name, production)
+        _active = None
@@ -1,28 +1,128 @@
+import codecs
 import io
 
-from ..e4 import Element, Document, FragmentType
+from . import Element, Document
+
+from typing import Iterator, Union
 
 
 def dump_tag(tag: Element, out: io.StringIO):
     inside = tag.name
-    if tag.attributes:
-        inside += ' ' + ' '.join((f'{key}="{value}"' for key, value in tag.attributes.items()))
+    if tag._attributes:
+        inside += ' ' + ' '.join((f'{key}="{value}"' for key, value in tag._attributes.items()))
     if tag.fragments:
         out.write(f'<{inside}>')
     else:
         out.write(f'<{inside}/>')
 
 
-def dump(root: Element, out: io.StringIO):
-    dump_tag(root, out)
-    if root.fragments:
-        for fragment in root.fragments:
-            if fragment.kind == FragmentType.ELEMENT:
-                dump(fragment.data, out)
+# Serializes the tree under root without recursion. Output pieces are joined into chunks
+# of about chunk_size pieces, which are yielded as str or, with an encoding, as bytes.
+# Characters the encoding cannot represent are written as character references.
+def iterdump(root: Element, encoding: str = None, chunk_size: int = 8 * 1024) -> Iterator[Union[str, bytes]]:
+    encoder = _encoder(encoding)
+    yield from _iterdump(root, encoder, chunk_size)
+    if encoder is not None and (tail := encoder('', True)):
+        yield tail
+
+
+def _iterdump(root: Element, encoder, chunk_size: int) -> Iterator[Union[str, bytes]]:
+    pieces = []
+    write = pieces.append
+    # Tags are formatted once per name
+    open_tags = {}
+    empty_tags = {}
+    close_tags = {}
+
+    stack = [iter((root,))]
+    names = []
+    while stack:
+        for fragment in stack[-1]:
+            if isinstance(fragment, Element):
+                name = fragment.name
+                if fragment._attributes:
+                    write(f'<{name}')
+                    for key, value in fragment._attributes.items():
+                        write(f' {key}="{value}"')
+                    write('>' if fragment.fragments else '/>')
+                elif fragment.fragments:
+                    tag = open_tags.get(name)
+                    if tag is None:
+                        tag = open_tags[name] = f'<{name}>'
+                    write(tag)
+                else:
+                    tag = empty_tags.get(name)
+                    if tag is None:
+                        tag = empty_tags[name] = f'<{name}/>'
+                    write(tag)
+
+                if fragment.fragments:
+                    stack.append(iter(fragment.fragments))
+                    names.append(name)
+                    break
+            elif isinstance(fragment, str):
+                # Parsed character data never needs escaping, resolved or added text may
+                if '&' in fragment or '<' in fragment or ']]>' in fragment:
+                    fragment = escape_text(fragment)
+                write(fragment)
             else:
-                out.write(fragment.data)
-        out.write(f'</{root.name}>')
+                write(fragment.data)
+
+            if len(pieces) >= chunk_size:
+                chunk = ''.join(pieces)
+                yield chunk if encoder is None else encoder(chunk)
+                pieces.clear()
+        else:
+            stack.pop()
+            if names:
+                name = names.pop()
+                tag = close_tags.get(name)
+                if tag is None:
+                    tag = close_tags[name] = f'</{name}>'
+                write(tag)
+
+    if pieces:
+        chunk = ''.join(pieces)
+        yield chunk if encoder is None else encoder(chunk)
+
+
+# See https://www.w3.org/TR/xml/#syntax
+def escape_text(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+# With an encoding the output starts with an XML declaration naming it
+def iterdump_document(document: Document, encoding: str = None, chunk_size: int = 8 * 1024) -> Iterator[Union[str, bytes]]:
+    encoder = _encoder(encoding)
+    if encoder is not None:
+        version = document.declaration.version if document.declaration is not None else '1.0'
+        yield encoder(f'<?xml version="{version}" encoding="{encoding}"?>')
+    yield from _iterdump(document.root, encoder, chunk_size)
+    if encoder is not None and (tail := encoder('', True)):
+        yield tail
+
+
+# Incremental, so that encodings with a byte order mark write it only once
+def _encoder(encoding: str):
+    if encoding is None:
+        return None
+    return codecs.getincrementalencoder(encoding)('xmlcharrefreplace').encode
+
+
+# out receives str chunks, or bytes ones when an encoding is given
+def dump(root: Element, out: io.StringIO, encoding: str = None):
+    for chunk in iterdump(root, encoding):
+        out.write(chunk)
+
+
+def dump_document(document: Document, out: io.StringIO, encoding: str = None):
+    if encoding is None:
+        dump(document.root, out)
+    else:
+        for chunk in iterdump_document(document, encoding):
+            out.write(chunk)
 
 
-def dump_document(document: Document, out: io.StringIO):
-    dump(document.root, out)
+def dump_file(document: Document, path, encoding: str = 'utf-8'):
+    with open(path, 'wb') as file:
+        dump_document(document, file, encoding)
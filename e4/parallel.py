@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+from . import Document, Declaration, Element, Fragment, FragmentType, _TAG_BODY, parse, parse_bytes, parse_file
+from . import decode_bytes, normalize_end_of_line, parse_xml_declaration, parse_white_space, parse_start_tag, parse_content, parse_end_tag
+
+from typing import Iterable, Iterator, Union
+
+import concurrent.futures
+import itertools
+import os
+import re
+
+
+# Documents cross the process boundary as one flat list instead of a pickled object graph:
+# an element is _START, its name and its attributes (None when there are none), followed by
+# its fragments and _END. Character data is a plain str and a reference is its marker
+# followed by the reference text.
+_START = 0
+_END = 1
+_CHAR_REFERENCE = 2
+_ENTITY_REFERENCE = 3
+
+
+def to_wire(document: Document) -> tuple:
+    if document is None:
+        return None
+    declaration = document.declaration
+    if declaration is not None:
+        declaration = (declaration.version, declaration.encoding, declaration.standalone)
+    return declaration, element_to_wire(document.root)
+
+
+def from_wire(wire: tuple) -> Document:
+    if wire is None:
+        return None
+    declaration, elements = wire
+    if declaration is not None:
+        declaration = Declaration(*declaration)
+    return Document(declaration, elements_from_wire(elements, None)[0])
+
+
+def element_to_wire(root: Element) -> list:
+    wire = []
+    write = wire.append
+    stack = [iter((root,))]
+    while stack:
+        for fragment in stack[-1]:
+            if isinstance(fragment, Element):
+                write(_START)
+                write(fragment.name)
+                write(fragment._attributes if fragment._attributes else None)
+                stack.append(iter(fragment.fragments))
+                break
+            elif isinstance(fragment, str):
+                write(fragment)
+            else:
+                write(_CHAR_REFERENCE if fragment.kind == FragmentType.CHAR_REFERENCE else _ENTITY_REFERENCE)
+                write(fragment.data)
+        else:
+            stack.pop()
+            if stack:
+                write(_END)
+    return wire
+
+
+# Rebuilds the top-level elements encoded in wire under parent
+def elements_from_wire(wire: list, parent: Element) -> list[Element]:
+    top_level = []
+    open_elements = []
+    element = parent
+    items = iter(wire)
+    for item in items:
+        if isinstance(item, str):
+            element.fragments.append(item)
+        elif item == _START:
+            name = next(items)
+            attributes = next(items)
+            child = Element(name=name, attributes=attributes, parent=element)
+            if element is not None:
+                element.fragments.append(child)
+            if not open_elements:
+                top_level.append(child)
+            open_elements.append(child)
+            element = child
+        elif item == _END:
+            open_elements.pop()
+            element = open_elements[-1] if open_elements else parent
+        else:
+            kind = FragmentType.CHAR_REFERENCE if item == _CHAR_REFERENCE else FragmentType.ENTITY_REFERENCE
+            element.fragments.append(Fragment(kind=kind, data=next(items)))
+    return top_level
+
+
+def _parse_source(source: Union[str, bytes, os.PathLike]) -> Document:
+    if isinstance(source, str):
+        return parse(source)
+    if isinstance(source, os.PathLike):
+        return parse_file(source)
+    return parse_bytes(source)
+
+
+def _parse_to_wire(sources: list) -> list:
+    return [to_wire(_parse_source(source)) for source in sources]
+
+
+def _parse_locally(sources: list) -> list:
+    return [_parse_source(source) for source in sources]
+
+
+# Parses independent documents on a pool of processes or threads. A source is XML text
+# (str), an encoded document (any other buffer) or a path (os.PathLike). Sources are read
+# lazily and submitted chunk_size at a time, with at most two chunks per worker in flight.
+# Documents are yielded in input order, or as (index, document) pairs in completion order
+# when ordered is false. A source that fails to parse yields None, as with parse.
+# Threads avoid the transfer cost but share one interpreter lock, so only processes spread
+# the parsing itself over several cores.
+def parse_many(sources: Iterable[Union[str, bytes, os.PathLike]], workers: int = None, executor: str = 'process',
+               ordered: bool = True, chunk_size: int = 16) -> Iterator[Union[Document, tuple[int, Document]]]:
+    if executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(workers)
+        task, decode = _parse_to_wire, from_wire
+    elif executor == 'thread':
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+        task, decode = _parse_locally, None
+    else:
+        raise ValueError(f'unknown executor {executor!r}, expected "process" or "thread"')
+
+    in_flight_limit = 2 * (workers or os.cpu_count() or 1)
+    chunks = _chunked(sources, chunk_size)
+    with pool:
+        if ordered:
+            yield from _ordered_results(pool, task, decode, chunks, in_flight_limit)
+        else:
+            yield from _completed_results(pool, task, decode, chunks, in_flight_limit)
+
+
+def _ordered_results(pool, task, decode, chunks, in_flight_limit) -> Iterator[Document]:
+    in_flight = [pool.submit(task, chunk) for _, chunk in itertools.islice(chunks, in_flight_limit)]
+    while in_flight:
+        results = in_flight.pop(0).result()
+        for _, chunk in itertools.islice(chunks, 1):
+            in_flight.append(pool.submit(task, chunk))
+        for result in results:
+            yield decode(result) if decode is not None else result
+
+
+def _completed_results(pool, task, decode, chunks, in_flight_limit) -> Iterator[tuple[int, Document]]:
+    in_flight = {pool.submit(task, chunk): start for start, chunk in itertools.islice(chunks, in_flight_limit)}
+    while in_flight:
+        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            start = in_flight.pop(future)
+            for start_of_next, chunk in itertools.islice(chunks, 1):
+                in_flight[pool.submit(task, chunk)] = start_of_next
+            for offset, result in enumerate(future.result()):
+                yield start + offset, decode(result) if decode is not None else result
+
+
+def _chunked(sources: Iterable, chunk_size: int) -> Iterator[tuple[int, list]]:
+    iterator = iter(sources)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+# Markup the pre-scan cannot delimit by matching tags: comments, CDATA sections and
+# processing instructions may contain '<' and '>' freely
+_AMBIGUOUS_MARKUP = re.compile('<[!?]')
+
+
+# Parses one large document whose root holds many sibling records on a pool of processes.
+# A pre-scan over the tags finds the boundaries between the root's children, contiguous
+# runs of children are parsed by parse_content in the workers, and the results are
+# attached under the root in order. Whenever the pre-scan cannot be trusted, the input is
+# too small to split or a worker fails, the document is parsed serially instead, so the
+# result is always the one parse would give.
+def parse_split(source: Union[str, bytes], workers: int = None, segments_per_worker: int = 4) -> Document:
+    if not isinstance(source, str):
+        source = decode_bytes(source)
+    text = normalize_end_of_line(source)
+
+    workers = workers or os.cpu_count() or 1
+    layout = _split_layout(text, workers * segments_per_worker) if workers > 1 else None
+    if layout is None:
+        return parse(text)
+    declaration, root, segments, content_end = layout
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        wires = list(pool.map(_parse_segment, segments))
+    if any(wire is None for wire in wires):
+        return parse(text)
+    for wire in wires:
+        elements_from_wire(wire, root)
+
+    _, ok = parse_end_tag(text, content_end, root)
+    if not ok:
+        return None
+    return Document(declaration, root)
+
+
+# Returns the declaration, the root element, the content split into segments at boundaries
+# between top-level children, and the offset of the root end tag
+def _split_layout(text: str, segment_count: int) -> tuple:
+    declaration, current, _ = parse_xml_declaration(text, 0)
+    _, current, _ = parse_white_space(text, current)
+    root, empty_element, current, ok = parse_start_tag(text, current, None)
+    if not ok or empty_element or _AMBIGUOUS_MARKUP.search(text, current) is not None:
+        return None
+    content_start = current
+
+    # Offsets right after each top-level child
+    boundaries = []
+    depth = 0
+    while True:
+        current = text.find('<', current)
+        if current < 0:
+            return None
+        tag_end = _TAG_BODY.match(text, current).end()
+        if tag_end >= len(text) or text[tag_end] != '>':
+            return None
+        if text[current + 1] == '/':
+            depth -= 1
+        elif text[tag_end - 1] != '/':
+            depth += 1
+        if depth < 0:
+            content_end = current
+            break
+        current = tag_end + 1
+        if depth == 0:
+            boundaries.append(current)
+
+    if len(boundaries) < 2:
+        return None
+    step = max(1, len(boundaries) // segment_count)
+    cuts = [content_start] + boundaries[step - 1:-1:step] + [content_end]
+    segments = [text[start:end] for start, end in zip(cuts, cuts[1:]) if end > start]
+    return declaration, root, segments, content_end
+
+
+def _parse_segment(segment: str) -> list:
+    holder = Element()
+    # parse_content stops at the first end tag it cannot match, which the sentinel provides
+    current, ok = parse_content(segment + '</', 0, holder, {})
+    if not ok or current != len(segment):
+        return None
+    # Only the fragments, without the holder's own start and end markers
+    return element_to_wire(holder)[3:-1]
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from . import Element, Document, _NAME
+
+from typing import Iterator, Union
+
+import functools
+import itertools
+import re
+
+
+# Path language:
+#   query     := ('/' | '//')? step (('/' | '//') step)*
+#   step      := (Name | '*') predicate*
+#   predicate := '[' '@' Name ('=' Literal)? ']' | '[' Integer ']'
+# A leading '/' starts from the document, whose only child is the root element, otherwise
+# steps start from the children of the context. '//' selects among all descendants, and
+# positional predicates count from 1 among the nodes sharing a parent, as in XPath.
+_STEP = re.compile(f'(//|/)?(\\*|{_NAME.pattern})')
+_PREDICATE = re.compile(f'\\[\\s*(?:@({_NAME.pattern})\\s*(?:=\\s*(?:"([^"]*)"|\'([^\']*)\'))?|([1-9][0-9]*))\\s*\\]')
+
+
+class _Step:
+    __slots__ = ('descendant', 'name', 'predicates')
+
+    def __init__(self, descendant: bool, name: str, predicates: list):
+        self.descendant = descendant
+        self.name = name
+        # (key, value) attribute tests, with value None for presence, or int positions
+        self.predicates = predicates
+
+    def select(self, node: Union[Element, Document]) -> Iterator[Element]:
+        candidates = _children(node)
+        if self.name != '*':
+            candidates = (child for child in candidates if child.name == self.name)
+        for predicate in self.predicates:
+            candidates = _apply(predicate, candidates)
+        return candidates
+
+
+class Query:
+    def __init__(self, text: str, steps: list[_Step], absolute: bool):
+        self.text = text
+        self.steps = steps
+        self.absolute = absolute
+
+    def __repr__(self):
+        return f'Query({self.text!r})'
+
+    # Results are produced lazily, so consumers that stop early do not pay for a full search
+    def iterate(self, context: Union[Element, Document]) -> Iterator[Element]:
+        if self.absolute and isinstance(context, Element):
+            while context.parent is not None:
+                context = context.parent
+            context = Document(None, context)
+
+        indexed = self._iterate_index(context)
+        if indexed is not None:
+            return indexed
+
+        nodes = iter((context,))
+        for position, step in enumerate(self.steps):
+            nodes = _apply_step(step, nodes, unique=step.descendant and position > 0)
+        return nodes
+
+    def first(self, context: Union[Element, Document]) -> Element:
+        return next(self.iterate(context), None)
+
+    def all(self, context: Union[Element, Document]) -> list[Element]:
+        return list(self.iterate(context))
+
+    # '//name' against a document whose index has already been built is answered by the index,
+    # as long as the index is in document order, so that results never depend on it. A stale
+    # index is left for Document.index to rebuild rather than rebuilt by a query.
+    def _iterate_index(self, context: Union[Element, Document]) -> Iterator[Element]:
+        if not isinstance(context, Document) or len(self.steps) != 1:
+            return None
+        index = context._index
+        if index is None or index.stale or index.root is not context.root:
+            return None
+        step = self.steps[0]
+        if not step.descendant or step.name == '*' or any(isinstance(predicate, int) for predicate in step.predicates):
+            return None
+        candidates = iter(context.find_all(step.name))
+        for predicate in step.predicates:
+            candidates = _apply(predicate, candidates)
+        return candidates
+
+
+@functools.lru_cache(maxsize=256)
+def compile_query(text: str) -> Query:
+    steps = []
+    absolute = False
+    current = 0
+    while current < len(text):
+        match = _STEP.match(text, current)
+        separator = match.group(1) if match is not None else None
+        if match is None or (steps and separator is None):
+            raise ValueError(f'invalid query {text!r} at position {current}')
+        if not steps:
+            absolute = separator is not None
+        current = match.end()
+
+        predicates = []
+        while True:
+            predicate = _PREDICATE.match(text, current)
+            if predicate is None:
+                break
+            key, double_quoted, single_quoted, position = predicate.groups()
+            if position is not None:
+                predicates.append(int(position))
+            else:
+                value = double_quoted if double_quoted is not None else single_quoted
+                predicates.append((key, value))
+            current = predicate.end()
+        steps.append(_Step(separator == '//', match.group(2), predicates))
+
+    if not steps:
+        raise ValueError('empty query')
+    return Query(text, steps, absolute)
+
+
+def select(context: Union[Element, Document], query: str) -> Iterator[Element]:
+    return compile_query(query).iterate(context)
+
+
+def select_first(context: Union[Element, Document], query: str) -> Element:
+    return compile_query(query).first(context)
+
+
+def _children(node: Union[Element, Document]) -> Iterator[Element]:
+    if isinstance(node, Document):
+        return iter((node.root,))
+    return (fragment for fragment in node.fragments if isinstance(fragment, Element))
+
+
+def _descendants_or_self(node: Union[Element, Document]) -> Iterator[Union[Element, Document]]:
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        children = list(_children(node))
+        children.reverse()
+        stack.extend(children)
+
+
+def _apply(predicate, candidates: Iterator[Element]) -> Iterator[Element]:
+    if isinstance(predicate, int):
+        return itertools.islice(candidates, predicate - 1, predicate)
+    key, value = predicate
+    # _attributes is None for elements without attributes, which this saves creating a dict for
+    if value is None:
+        return (candidate for candidate in candidates if candidate._attributes and key in candidate._attributes)
+    return (candidate for candidate in candidates if candidate._attributes and candidate._attributes.get(key) == value)
+
+
+def _apply_step(step: _Step, nodes: Iterator[Union[Element, Document]], unique: bool) -> Iterator[Element]:
+    seen = set() if unique else None
+    for node in nodes:
+        for parent in _descendants_or_self(node) if step.descendant else (node,):
+            for element in step.select(parent):
+                if seen is not None:
+                    if id(element) in seen:
+                        continue
+                    seen.add(id(element))
+                yield element
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from . import Document, Element, _NAME, _CHAR_DATA, invalidate_views, normalize_end_of_line
+from . import parse_xml_declaration, parse_white_space, parse_start_tag, parse_content, parse_end_tag
+
+from typing import Callable, Iterable
+
+import re
+
+
+# Whole tokens for the scanner that checks skipped subtrees, accepting what the productions
+# accept: attribute values without '<' or '&', and character or entity references
+_SPACE = '[ \\t\\r\\n]'
+_ATTRIBUTES = f'(?:{_SPACE}+{_NAME.pattern}{_SPACE}*={_SPACE}*(?:"[^<&"]*"|\'[^<&\']*\'))*{_SPACE}*'
+_REFERENCE_PATTERN = f'&(?:#x[0-9a-fA-F]+|#[0-9]+|{_NAME.pattern});'
+_START_TAG = re.compile(f'<({_NAME.pattern}){_ATTRIBUTES}(/?)>')
+_END_TAG = re.compile(f'</({_NAME.pattern}){_SPACE}*>')
+_REFERENCE = re.compile(_REFERENCE_PATTERN)
+# A whole element holding only text, which is how most skipped elements are matched at once.
+# The text is written as an unrolled loop, so a failed match backtracks in linear time.
+_LEAF = re.compile(f'<({_NAME.pattern}){_ATTRIBUTES}>([^<&]*(?:{_REFERENCE_PATTERN}[^<&]*)*)</\\1{_SPACE}*>')
+
+
+# Parses only the parts of a document that are asked for. An element is wanted when its path
+# of names from the root, as in '/feed/entry/id', is one of paths, or when predicate returns
+# true for it; predicate receives the element with its name and attributes, and its parent
+# chain up to the root, whose children and text views it may read: every element is
+# invalidated when fragments are added to it later. Wanted elements are built in full. Their ancestors are kept with
+# their attributes but only their wanted descendants, without text. Everything else is
+# checked for well-formedness by a scanner that builds nothing, and dropped.
+# Returns None for a malformed document, like parse.
+def parse_selected(xml: str, paths: Iterable[str] = (), predicate: Callable[[Element], bool] = None,
+                   names: dict[str, str] = None) -> Document:
+    text = normalize_end_of_line(xml)
+    if names is None:
+        names = {}
+    wanted = {tuple(path.strip('/').split('/')) for path in paths}
+    # Paths leading to a wanted element; with a predicate any element may lead to one
+    prefixes = {path[:length] for path in wanted for length in range(1, len(path))}
+
+    declaration, current, _ = parse_xml_declaration(text, 0)
+    _, current, _ = parse_white_space(text, current)
+    root, empty_element, current, ok = parse_start_tag(text, current, None, names)
+    if not ok:
+        return None
+    if (root.name,) in wanted or (predicate is not None and predicate(root)):
+        if not empty_element:
+            current, ok = parse_content(text, current, root, names)
+            invalidate_views(root)
+            if ok:
+                current, ok = parse_end_tag(text, current, root)
+        return Document(declaration, root) if ok else None
+    if empty_element:
+        return Document(declaration, root)
+
+    # Open elements along with their paths. Those below the first `attached` ones have not
+    # been added to their parent yet, which only happens once a wanted element shows up below.
+    open_elements = [root]
+    open_paths = [(root.name,)]
+    attached = 1
+    end = len(text)
+    while True:
+        if current >= end:
+            return None
+        char = text[current]
+        if char == '<':
+            if text[current + 1:current + 2] == '/':
+                current, ok = parse_end_tag(text, current, open_elements[-1])
+                if not ok:
+                    return None
+                open_elements.pop()
+                open_paths.pop()
+                attached = min(attached, len(open_elements))
+                if not open_elements:
+                    return Document(declaration, root)
+                continue
+
+            # Without a predicate, the name alone decides whether an element is built at all
+            if predicate is None:
+                name = _NAME.match(text, current + 1)
+                if name is None:
+                    return None
+                path = open_paths[-1] + (name.group(),)
+                if path not in wanted and path not in prefixes:
+                    current, ok = _skip_element(text, current)
+                    if not ok:
+                        return None
+                    continue
+
+            parent = open_elements[-1]
+            element, empty_element, current, ok = parse_start_tag(text, current, parent, names)
+            if not ok:
+                return None
+            path = open_paths[-1] + (element.name,)
+            if path in wanted or (predicate is not None and predicate(element)):
+                if not empty_element:
+                    current, ok = parse_content(text, current, element, names)
+                    invalidate_views(element)
+                    if ok:
+                        current, ok = parse_end_tag(text, current, element)
+                    if not ok:
+                        return None
+                for index in range(attached, len(open_elements)):
+                    open_elements[index - 1].fragments.append(open_elements[index])
+                    invalidate_views(open_elements[index - 1])
+                attached = len(open_elements)
+                parent.fragments.append(element)
+                invalidate_views(parent)
+            elif not empty_element:
+                open_elements.append(element)
+                open_paths.append(path)
+        elif char == '&':
+            match = _REFERENCE.match(text, current)
+            if match is None:
+                return None
+            current = match.end()
+        else:
+            current, ok = _skip_char_data(text, current)
+            if not ok:
+                return None
+
+
+def _skip_char_data(text: str, at: int) -> tuple[int, bool]:
+    current = _CHAR_DATA.match(text, at).end()
+    return current, text.find(']]>', at, current) < 0
+
+
+# Scans past the element starting at `at`, checking that it is well-formed
+# TODO(Compliance): add support for CDSects, PIs and Comments
+def _skip_element(text: str, at: int) -> tuple[int, bool]:
+    open_names = []
+    current = at
+    end = len(text)
+    while current < end:
+        char = text[current]
+        if char == '<':
+            if text[current + 1:current + 2] == '/':
+                match = _END_TAG.match(text, current)
+                if match is None or not open_names or match.group(1) != open_names.pop():
+                    return current, False
+            else:
+                match = _LEAF.match(text, current)
+                if match is not None:
+                    if text.find(']]>', match.start(2), match.end(2)) >= 0:
+                        return current, False
+                else:
+                    match = _START_TAG.match(text, current)
+                    if match is None:
+                        return current, False
+                    if not match.group(2):
+                        open_names.append(match.group(1))
+            current = match.end()
+            if not open_names:
+                return current, True
+        elif char == '&':
+            match = _REFERENCE.match(text, current)
+            if match is None:
+                return current, False
+            current = match.end()
+        else:
+            current, ok = _skip_char_data(text, current)
+            if not ok:
+                return current, False
+    return current, False
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+from . import BadFormat, Declaration, _NAME, _CHAR_REFERENCE, normalize_end_of_line, parse_xml_declaration, parse_white_space
+
+from typing import Iterator
+
+import array
+import enum
+import itertools
+import re
+
+
+class TokenKind(enum.IntEnum):
+    # Span of the element name. Empty elements get an END token too, spanning the same name,
+    # so START and END tokens always balance.
+    START = 0
+    END = 1
+    # Spans of an attribute name and of its value without the quotes; they follow the START
+    # token of their element
+    ATTRIBUTE_NAME = 2
+    ATTRIBUTE_VALUE = 3
+    TEXT = 4
+    # Spans of the whole reference, including '&' and ';'
+    CHAR_REFERENCE = 5
+    ENTITY_REFERENCE = 6
+
+
+_START_TAG_NAME = re.compile(f'<({_NAME.pattern})')
+_ATTRIBUTE = re.compile(f'[ \\t\\r\\n]+({_NAME.pattern})[ \\t\\r\\n]*=[ \\t\\r\\n]*(?:"([^<&"]*)"|\'([^<&\']*)\')')
+_START_TAG_CLOSE = re.compile('[ \\t\\r\\n]*(/?)>')
+_END_TAG = re.compile(f'</({_NAME.pattern})[ \\t\\r\\n]*>')
+_ENTITY_REFERENCE = re.compile(f'&{_NAME.pattern};')
+_TEXT = re.compile('[^<&]+')
+
+
+class Token:
+    __slots__ = ('kind', 'start', 'end', 'source')
+
+    def __init__(self, kind: TokenKind, start: int, end: int, source: str):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.source = source
+
+    def __repr__(self):
+        return f'Token({self.kind.name}, {self.start}, {self.end})'
+
+    # The characters are only copied out of the source when asked for
+    @property
+    def value(self) -> str:
+        return self.source[self.start:self.end]
+
+
+# Tokens of one document as a flat array of (kind, start, end) triples of offsets into text,
+# which is the end-of-line normalized source. Nothing is sliced out of the text until a
+# value is requested.
+class TokenStream:
+    __slots__ = ('text', 'declaration', 'records')
+
+    def __init__(self, text: str, declaration: Declaration, records: array.array):
+        self.text = text
+        self.declaration = declaration
+        self.records = records
+
+    def __len__(self) -> int:
+        return len(self.records) // 3
+
+    def __getitem__(self, index: int) -> Token:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+        records = self.records
+        return Token(TokenKind(records[3 * index]), records[3 * index + 1], records[3 * index + 2], self.text)
+
+    def __iter__(self) -> Iterator[Token]:
+        return (self[index] for index in range(len(self)))
+
+    def kind(self, index: int) -> TokenKind:
+        return TokenKind(self.records[3 * index])
+
+    def span(self, index: int) -> tuple[int, int]:
+        return self.records[3 * index + 1], self.records[3 * index + 2]
+
+    def value(self, index: int) -> str:
+        return self.text[self.records[3 * index + 1]:self.records[3 * index + 2]]
+
+    # (kind, start, end) triples with plain int kinds, the cheapest way to walk the stream
+    def spans(self) -> Iterator[tuple[int, int, int]]:
+        records = self.records
+        return zip(records[0::3], records[1::3], records[2::3])
+
+
+# Tokenizes a whole document into a TokenStream. Unlike parse, which returns None, malformed
+# input raises BadFormat with the offset of the problem in the normalized text, which the
+# error keeps for its line_column.
+def tokenize(text: str) -> TokenStream:
+    text = normalize_end_of_line(text)
+    declaration, current = _skip_prolog(text)
+    records = array.array('q', itertools.chain.from_iterable(iterate_spans(text, current)))
+    return TokenStream(text, declaration, records)
+
+
+# Yields the (kind, start, end) span of every token, as plain ints, while scanning text, so
+# consumers such as e4.columns can act on each token without the whole stream being stored.
+# text must be end-of-line normalized already; scanning starts at the root element, at `at`,
+# or after the XML declaration and white space when at is None. Malformed input raises
+# BadFormat as with tokenize, once the tokens before the problem have been yielded.
+# TODO(Compliance): add support for CDSects, PIs and Comments
+def iterate_spans(text: str, at: int = None) -> Iterator[tuple[int, int, int]]:
+    START, END, ATTRIBUTE_NAME, ATTRIBUTE_VALUE, TEXT, CHAR_REFERENCE, ENTITY_REFERENCE = map(int, TokenKind)
+    current = _skip_prolog(text)[1] if at is None else at
+    end = len(text)
+
+    # Offsets of the names of the open elements
+    open_names = []
+    while True:
+        if current >= end:
+            raise BadFormat('unexpected end of input', current, text)
+
+        if text[current] == '<':
+            if text[current + 1:current + 2] == '/':
+                match = _END_TAG.match(text, current)
+                if match is None or not open_names:
+                    raise BadFormat('malformed end tag', current, text)
+                name_start, name_end = match.span(1)
+                open_start, open_end = open_names.pop()
+                if text[name_start:name_end] != text[open_start:open_end]:
+                    raise BadFormat('mismatched end tag', current, text)
+                yield END, name_start, name_end
+                current = match.end()
+            else:
+                match = _START_TAG_NAME.match(text, current)
+                if match is None:
+                    raise BadFormat('malformed start tag', current, text)
+                name_start, name_end = match.span(1)
+                yield START, name_start, name_end
+                current = match.end()
+                while True:
+                    attribute = _ATTRIBUTE.match(text, current)
+                    if attribute is None:
+                        break
+                    yield (ATTRIBUTE_NAME, *attribute.span(1))
+                    yield (ATTRIBUTE_VALUE, *(attribute.span(2) if attribute.start(2) >= 0 else attribute.span(3)))
+                    current = attribute.end()
+                close = _START_TAG_CLOSE.match(text, current)
+                if close is None:
+                    raise BadFormat('malformed start tag', current, text)
+                current = close.end()
+                if close.group(1):
+                    yield END, name_start, name_end
+                else:
+                    open_names.append((name_start, name_end))
+            if not open_names:
+                return
+        elif not open_names:
+            raise BadFormat('expected the root element', current, text)
+        elif text[current] == '&':
+            match = _CHAR_REFERENCE.match(text, current)
+            kind = CHAR_REFERENCE
+            if match is None:
+                match = _ENTITY_REFERENCE.match(text, current)
+                kind = ENTITY_REFERENCE
+                if match is None:
+                    raise BadFormat('malformed reference', current, text)
+            start = current
+            current = match.end()
+            yield kind, start, current
+        else:
+            run_end = _TEXT.match(text, current).end()
+            end_of_cdata = text.find(']]>', current, run_end)
+            if end_of_cdata >= 0:
+                raise BadFormat("']]>' in character data", end_of_cdata, text)
+            yield TEXT, current, run_end
+            current = run_end
+
+
+def _skip_prolog(text: str) -> tuple[Declaration, int]:
+    declaration, current, _ = parse_xml_declaration(text, 0)
+    if declaration is None:
+        current = 0
+    _, current, _ = parse_white_space(text, current)
+    return declaration, current
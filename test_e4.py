@@ -1,4 +1,25 @@
-from e4 import parse, parse_xml_declaration, FragmentType
+import array
+import asyncio
+import copy
+import io
+import pickle
+
+import pytest
+
+from e4 import parse, parse_xml_declaration, FragmentType, normalize_end_of_line, EndOfLineNormalizer, iterparse, aiterparse, FeedParser, BadFormat
+from e4 import detect_encoding, parse_bytes, parse_file, fragment_kind, Element, Fragment, reparse, parse_strict, LineIndex
+from e4.functions import append_child, append_text, insert_child, insert_text, remove_child, remove_fragment, child_count, nth_child, find_first
+from e4.functions import extend_children, clone, TreeBuilder
+from e4.io import dump_document, dump_file, iterdump, iterdump_document
+from e4.query import compile_query, select, select_first
+from e4.parallel import parse_many, parse_split, to_wire, from_wire
+from e4 import parse_white_space, parse_char_data, parse_name, parse_attribute_value, parse_char_reference
+from e4.instrument import instrument
+from e4.tokens import tokenize, iterate_spans, TokenKind
+from e4.selective import parse_selected
+from e4.columns import extract_columns
+from e4.cache import encode, decode, dump_cache, load_cache, parse_cached, source_key
+from bench import SHAPES, generate, regressions, run_build, run_scaling
 
 
 def assert_element(element, /, name, nchildren, attributes, text):
@@ -181,6 +202,956 @@ def test_body_with_unencoded_unicode_characters():
                    text='è \u2603')
 
 
+def test_scanner_white_space():
+    assert parse_white_space('a \t\r\nb', 1) == (' \t\r\n', 5, True)
+    assert parse_white_space('ab', 1) == ('', 1, False)
+    assert parse_white_space('a', 1) == ('', 1, False)
+
+
+def test_scanner_char_data():
+    assert parse_char_data('>text&amp;', 1) == ('text', 5, True)
+    assert parse_char_data('>text', 1) == ('text', 5, True)
+    assert parse_char_data('>te]]>xt<', 1) == ('te', 3, False)
+
+
+def test_scanner_name():
+    assert parse_name('<my:el-e.m_1 a="b">', 1) == ('my:el-e.m_1', 12, True)
+    assert parse_name('<1abc>', 1) == ('', 1, False)
+    assert parse_name('<', 1) == ('', 1, False)
+
+
+def test_scanner_attribute_value():
+    assert parse_attribute_value('a="v\'al"/>', 2) == ('"v\'al"', 8, True)
+    assert parse_attribute_value("a='v\"al'/>", 2) == ("'v\"al'", 8, True)
+    assert parse_attribute_value('a="v<al"/>', 2)[2] is False
+    assert parse_attribute_value('a="val', 2)[2] is False
+    assert parse_attribute_value('a=val', 2)[2] is False
+
+
+def test_scanner_char_reference():
+    assert parse_char_reference('&#x1F;', 0) == ('&#x1F;', 6, True)
+    assert parse_char_reference('&#123;', 0) == ('&#123;', 6, True)
+    assert parse_char_reference('&#x;', 0)[2] is False
+    assert parse_char_reference('&#12', 0)[2] is False
+    assert parse_char_reference('&amp;', 0)[2] is False
+
+
+def test_normalize_end_of_line():
+    assert normalize_end_of_line('a\r\nb\rc\r\x85d\x85e\u2028f\n') == 'a\nb\nc\nd\ne\nf\n'
+    text = 'no line breaks to fix\n'
+    assert normalize_end_of_line(text) is text
+
+
+def test_normalize_end_of_line_across_chunks():
+    normalizer = EndOfLineNormalizer()
+    chunks = ['a\r', '\nb\r', '\r', 'c\r']
+    normalized = ''.join(normalizer.normalize(chunk) for chunk in chunks) + normalizer.normalize('', final=True)
+    assert normalized == 'a\nb\n\nc\n'
+
+
+def test_parse_normalizes_end_of_line():
+    element = parse('<element a="1\r\n2">line\r\nline\rline<sub>\r\n</sub></element>')
+    assert element.root.fragments[0] == 'line\nline\nline'
+    assert element.root.children[0].fragments[0] == '\n'
+    assert element.root.attributes == {'a': '1\n2'}
+
+
+def test_deeply_nested_elements():
+    depth = 5000
+    document = parse('<e>' * depth + 'leaf' + '</e>' * depth)
+    element = document.root
+    for _ in range(depth - 1):
+        assert len(element.children) == 1
+        assert element.children[0].parent is element
+        element = element.children[0]
+    assert element.text == ['leaf']
+
+
+def test_nested_siblings_keep_document_order():
+    document = parse('<a>1<b>2<c/>3</b>4<d>5</d>6</a>')
+    root = document.root
+    assert [fragment_kind(fragment) for fragment in root.fragments] == [FragmentType.CHAR_DATA, FragmentType.ELEMENT, FragmentType.CHAR_DATA,
+                                                              FragmentType.ELEMENT, FragmentType.CHAR_DATA]
+    assert [child.name for child in root.children] == ['b', 'd']
+    assert root.children[0].text == ['2', '3']
+    assert root.children[0].children[0].name == 'c'
+    assert root.children[1].text == ['5']
+
+
+def test_malformed_content_fails():
+    assert parse('<a><b></a>') is None
+    assert parse('<a>&</a>') is None
+    assert parse('<a><!-- comment --></a>') is None
+    assert parse('<a>unterminated') is None
+    assert parse('<a><b') is None
+
+
+def snapshot(element):
+    fragments = []
+    for fragment in element.fragments:
+        if isinstance(fragment, Element):
+            fragments.append(snapshot(fragment))
+        elif isinstance(fragment, str):
+            fragments.append(fragment)
+        else:
+            fragments.append((fragment.kind, fragment.data))
+    return element.name, dict(element.attributes), fragments
+
+
+STREAM_SOURCE = '<?xml version="1.0"?>\r\n<feed a="1"><entry id="x>y">one &amp; &#x41;\r\ntwo</entry>\r\n<entry id=\'2\'/></feed>\r\n'
+
+
+def test_iterparse_events():
+    events = [(event, element.name) for event, element in iterparse(io.StringIO(STREAM_SOURCE))]
+    assert events == [('start', 'feed'), ('start', 'entry'), ('end', 'entry'), ('start', 'entry'), ('end', 'entry'), ('end', 'feed')]
+
+
+def test_iterparse_matches_parse_at_any_chunk_boundary():
+    expected = snapshot(parse(STREAM_SOURCE).root)
+    for chunk_size in range(1, len(STREAM_SOURCE) + 1):
+        (_, root), = iterparse(io.StringIO(STREAM_SOURCE), events=('end',), tag='feed', chunk_size=chunk_size)
+        assert snapshot(root) == expected
+
+
+def test_iterparse_bytes():
+    (_, root), = iterparse(io.BytesIO(STREAM_SOURCE.replace('two', 'tw\u00f6').encode('utf-8')), events=('end',), tag='feed', chunk_size=3)
+    assert root.children[0].text[-1] == '\ntw\u00f6'
+
+
+def test_iterparse_clear():
+    source = '<feed>' + ''.join(f'\n<entry id="{index}"><title>{index}</title></entry>' for index in range(100)) + '\n</feed>'
+    ids = []
+    for event, element in iterparse(io.StringIO(source), events=('end',), tag='entry', clear=True, chunk_size=64):
+        ids.append(element.attributes['id'])
+        assert element.children[0].text == [element.attributes['id']]
+        assert len(element.parent.fragments) < 10
+    assert ids == [str(index) for index in range(100)]
+
+
+@pytest.mark.parametrize('tag', [None, 'entry'])
+def test_iterparse_clear_keeps_record_content(tag):
+    source = '<feed>' + ''.join(f'<entry id="{index}"><title>{index}</title><entry id="inner"/></entry>' for index in range(50)) + '</feed>'
+    records = []
+    for event, element in iterparse(io.StringIO(source), events=('end',), tag=tag, clear=True, chunk_size=16):
+        if element.parent is not None and element.parent.name == 'feed':
+            assert [child.name for child in element.children] == ['title', 'entry']
+            assert element.children[0].text == [element.attributes['id']]
+            assert len(element.parent.fragments) < 5
+            records.append(element.attributes['id'])
+    assert records == [str(index) for index in range(50)]
+
+
+def test_iterparse_malformed():
+    with pytest.raises(BadFormat):
+        list(iterparse(io.StringIO('<a><b></a>')))
+    with pytest.raises(BadFormat):
+        list(iterparse(io.StringIO('<a><b>')))
+    with pytest.raises(ValueError):
+        list(iterparse(io.StringIO('<a/>'), events=('begin',)))
+
+
+def test_feed_parser_resumes_inside_tokens():
+    source = '<feed><entry-name attribute="long value">x&#x263A;y&amp;z</entry-name></feed>'
+    expected = snapshot(parse(source).root)
+    for split in range(1, len(source)):
+        parser = FeedParser(events=('start', 'end'))
+        parser.feed(source[:split])
+        parser.feed(source[split:])
+        document = parser.close()
+        assert snapshot(document.root) == expected
+        assert [(event, element.name) for event, element in parser.read_events()] == [
+            ('start', 'feed'), ('start', 'entry-name'), ('end', 'entry-name'), ('end', 'feed')]
+
+
+def test_feed_parser_reports_elements_as_they_complete():
+    parser = FeedParser()
+    parser.feed(b'<feed><entry>1</ent')
+    assert list(parser.read_events()) == []
+    parser.feed(b'ry><entry>\xe2\x98')
+    (event, element), = parser.read_events()
+    assert (event, element.text) == ('end', ['1'])
+    parser.feed(b'\xba</entry></feed>')
+    assert [element.text for _, element in parser.read_events()] == [['\u263a'], []]
+    assert parser.close().root.name == 'feed'
+
+
+def test_aiterparse():
+    async def main():
+        reader = asyncio.StreamReader()
+        received = []
+
+        async def consume():
+            async for event, element in aiterparse(reader, tag='entry'):
+                received.append(element.attributes['id'])
+
+        consumer = asyncio.create_task(consume())
+        reader.feed_data(b'<feed><entry id="1"/><entry id=')
+        await asyncio.sleep(0)
+        assert received == ['1']
+        reader.feed_data(b'"2"/></feed>')
+        reader.feed_eof()
+        await consumer
+        return received
+
+    assert asyncio.run(main()) == ['1', '2']
+
+
+def test_detect_encoding():
+    assert detect_encoding(b'<a/>') == ('utf-8', 0)
+    assert detect_encoding(b'\xef\xbb\xbf<a/>') == ('utf-8', 3)
+    assert detect_encoding('\ufeff<a/>'.encode('utf-16-le')) == ('utf-16-le', 2)
+    assert detect_encoding('\ufeff<a/>'.encode('utf-32-le')) == ('utf-32-le', 4)
+    assert detect_encoding('<?xml version="1.0"?><a/>'.encode('utf-16-be')) == ('utf-16-be', 0)
+    assert detect_encoding(b'<?xml version="1.0" encoding="ISO-8859-1"?><a/>') == ('ISO-8859-1', 0)
+    assert detect_encoding(b'<?xml version="1.0" enc', final=False) is None
+    assert detect_encoding(b'\xff\xfe', final=False) is None
+    with pytest.raises(BadFormat):
+        detect_encoding(b'<?xml version="1.0" encoding="no-such-encoding"?><a/>')
+
+
+def test_parse_bytes():
+    document = parse_bytes('<?xml version="1.0" encoding="latin-1"?><a b="\u00e9">\u00e8</a>'.encode('latin-1'))
+    assert document.declaration.encoding == 'latin-1'
+    assert_element(document.root, name='a', nchildren=0, attributes={'b': '\u00e9'}, text='\u00e8')
+    document = parse_bytes(memoryview('\ufeff<a>\u2603</a>'.encode('utf-16-le')))
+    assert document.root.text == ['\u2603']
+    with pytest.raises(BadFormat):
+        parse_bytes(b'<a>\xff</a>')
+
+
+def test_parse_file(tmp_path):
+    path = tmp_path / 'document.xml'
+    path.write_bytes('\ufeff<a>\r\n\u2603</a>'.encode('utf-8'))
+    assert parse_file(path).root.text == ['\n\u2603']
+    (tmp_path / 'empty.xml').write_bytes(b'')
+    assert parse_file(tmp_path / 'empty.xml') is None
+
+
+def test_feed_parser_detects_encoding():
+    encoded = '<?xml version="1.0" encoding="utf-16"?><a>\u2603</a>'.encode('utf-16')
+    parser = FeedParser()
+    for index in range(len(encoded)):
+        parser.feed(encoded[index:index + 1])
+    assert parser.close().root.text == ['\u2603']
+
+
+def test_compact_node_model():
+    document = parse('<a><b/><c x="1">text&amp;</c></a>')
+    b, c = document.root.children
+    assert not hasattr(b, '__dict__')
+    assert b._attributes is None and c._attributes == {'x': '1'}
+    assert b.attributes == {} and b._attributes == {}
+    assert b.attributes is not document.root.attributes
+    assert c.fragments[0] == 'text'
+    assert fragment_kind(c.fragments[0]) == FragmentType.CHAR_DATA
+    assert fragment_kind(c.fragments[1]) == FragmentType.ENTITY_REFERENCE
+    assert document.root.fragments[0].kind == FragmentType.ELEMENT
+    assert document.root.fragments[0].data is b
+    # Text fragments are plain str, without kind/data; conditions go through fragment_kind
+    assert not hasattr(c.fragments[0], 'kind')
+    assert find_first(c, lambda fragment: fragment_kind(fragment) == FragmentType.CHAR_DATA) == 'text'
+    assert find_first(c, lambda fragment: fragment_kind(fragment) == FragmentType.ENTITY_REFERENCE).data == '&amp;'
+
+
+def test_pickle_and_copy_parsed_tree():
+    document = parse('<a><b/><c x="1">t&amp;</c></a>')
+    for copied in [pickle.loads(pickle.dumps(document)), copy.deepcopy(document)]:
+        assert copied.root._attributes is None
+        assert snapshot(copied.root) == snapshot(document.root)
+
+
+def test_mutate_parsed_tree():
+    document = parse('<a><b/></a>')
+    b = document.root.children[0]
+    b.attributes['id'] = '1'
+    assert b.attributes == {'id': '1'}
+    assert document.root.attributes == {}
+    append_child(b, Element(name='c'))
+    append_text(b, 'text')
+    out = io.StringIO()
+    dump_document(document, out)
+    assert out.getvalue() == '<a><b id="1"><c/>text</b></a>'
+
+
+def test_cached_views_follow_mutations():
+    root = parse('<a>x<b/>y<c/></a>').root
+    b, c = root.children
+    assert root.children is root.children
+    assert root.text is root.text
+    assert child_count(root) == 2
+    assert nth_child(root, 1) is c
+
+    d = Element(name='d')
+    insert_child(root, 0, d)
+    assert root.children == [d, b, c]
+    append_child(root, Element(name='e'))
+    assert [child.name for child in root.children] == ['d', 'b', 'c', 'e']
+    insert_text(root, 0, 'w')
+    append_text(root, 'z')
+    assert root.text == ['w', 'x', 'y', 'z']
+    remove_child(root, b)
+    assert b.parent is None
+    assert [child.name for child in root.children] == ['d', 'c', 'e']
+    assert remove_fragment(root, 0) == 'w'
+    assert root.text == ['x', 'y', 'z']
+    with pytest.raises(ValueError):
+        remove_child(root, b)
+
+
+def test_cached_views_during_streaming():
+    parser = FeedParser(events=('start',))
+    parser.feed('<a>x<b/>')
+    (_, root), (_, b) = parser.read_events()
+    assert root.children == [b]
+    assert root.text == ['x']
+    parser.feed('y<c/></a>')
+    parser.close()
+    assert [child.name for child in root.children] == ['b', 'c']
+    assert root.text == ['x', 'y']
+
+
+def test_document_index():
+    document = parse('<feed><entry id="1"><id>a</id></entry><entry id="2"><id>b</id></entry><other id="1"/></feed>')
+    first, second = document.root.children[:2]
+    assert document.find_all('entry') == [first, second]
+    assert [element.text for element in document.find_all('id')] == [['a'], ['b']]
+    assert document.find_all('missing') == []
+    assert document.find_by_attribute('id', '1') is first
+    assert document.find_by_attribute('id', '3') is None
+
+    third = Element(name='entry', attributes={'id': '3'})
+    append_child(third, Element(name='id'))
+    insert_child(document.root, 0, third)
+    assert document.find_all('entry') == [third, first, second]
+    assert len(document.find_all('id')) == 3
+    assert document.find_by_attribute('id', '3') is third
+
+    remove_child(document.root, first)
+    assert document.find_all('entry') == [third, second]
+    assert document.find_by_attribute('id', '1') is document.root.children[-1]
+
+    # An element inserted before the first carrier of a value becomes its first carrier
+    earlier = Element(name='other', attributes={'id': '2'})
+    insert_child(document.root, 1, earlier)
+    assert document.find_by_attribute('id', '2') is earlier
+    assert document.find_all('other') == [earlier, document.root.children[-1]]
+
+    # Appending at the end of the document extends the index in place
+    index = document.index
+    last = Element(name='entry', attributes={'id': '9'})
+    append_child(document.root, last)
+    extend_children(last, [Element(name='id')])
+    assert document.index is index
+    assert document.find_all('entry')[-1] is last and document.find_all('id')[-1] is last.children[0]
+    assert document.find_by_attribute('id', '9') is last
+    # Appending inside an element that is not last is an insertion in the middle
+    append_child(third, Element(name='id'))
+    assert document.index is not index
+    assert document.find_all('id')[1] is third.children[1]
+
+
+def test_document_index_removal_refills_attribute_tables():
+    document = parse('<r><s><a id="1" k="x"/><b id="2"/></s><a id="1" k="y"/><c id="2" k="x"/></r>')
+    document.build_index(['id', 'k'])
+    s, second, third = document.root.children
+    remove_child(document.root, s)
+    assert document.find_by_attribute('id', '1') is second
+    assert document.find_by_attribute('id', '2') is third
+    assert document.find_by_attribute('k', 'x') is third
+    assert document.find_all('a') == [second] and document.find_all('b') == []
+
+
+QUERY_SOURCE = '<feed><entry id="1"><id>a</id><link/></entry><entry id="2"><id>b</id><sub><id>c</id></sub></entry></feed>'
+
+
+def test_query_results_do_not_depend_on_the_index():
+    for build_index in (False, True):
+        document = parse('<r><e id="1"/><e id="2"/></r>')
+        if build_index:
+            document.build_index()
+        insert_child(document.root, 0, Element(name='e', attributes={'id': '0'}))
+        assert [element.attributes['id'] for element in select(document, '//e')] == ['0', '1', '2']
+        assert select_first(document, '//e').attributes['id'] == '0'
+        assert [element.attributes['id'] for element in select(document, '//e[@id="2"]')] == ['2']
+
+
+def names_and_text(elements):
+    return [(element.name, ''.join(element.text)) for element in elements]
+
+
+def test_query_steps():
+    document = parse(QUERY_SOURCE)
+    assert names_and_text(select(document, '/feed/entry/id')) == [('id', 'a'), ('id', 'b')]
+    assert names_and_text(select(document, '//id')) == [('id', 'a'), ('id', 'b'), ('id', 'c')]
+    assert names_and_text(select(document, '//entry[@id="2"]//id')) == [('id', 'b'), ('id', 'c')]
+    assert names_and_text(select(document, "//entry[@id='1']/*")) == [('id', 'a'), ('link', '')]
+    assert names_and_text(select(document, '//*[@id]')) == [('entry', ''), ('entry', '')]
+    assert names_and_text(select(document, '/feed/entry[2]/id')) == [('id', 'b')]
+    assert names_and_text(select(document, '//id[1]')) == [('id', 'a'), ('id', 'b'), ('id', 'c')]
+    assert list(select(document, '/entry')) == []
+
+
+def test_query_context_element():
+    document = parse(QUERY_SOURCE)
+    entry = document.root.children[1]
+    assert names_and_text(select(entry, 'id')) == [('id', 'b')]
+    assert names_and_text(select(entry, '/feed/entry/id')) == [('id', 'a'), ('id', 'b')]
+    assert select_first(entry, 'missing') is None
+
+
+def test_query_is_lazy_and_cached():
+    document = parse(QUERY_SOURCE)
+    query = compile_query('//id')
+    assert compile_query('//id') is query
+    results = query.iterate(document)
+    assert next(results).text == ['a']
+    assert query.first(document) is document.root.children[0].children[0]
+    document.build_index()
+    assert names_and_text(query.all(document)) == [('id', 'a'), ('id', 'b'), ('id', 'c')]
+    for invalid in ['', 'a/', 'a[', 'a[0]', 'a b', '//']:
+        with pytest.raises(ValueError):
+            compile_query(invalid)
+
+
+def test_iterdump_chunks():
+    source = '<a x="1" y="2"><b/>t&amp;<c>x<d/></c><e></e>z</a>'
+    root = parse(source).root
+    expected = '<a x="1" y="2"><b/>t&amp;<c>x<d/></c><e/>z</a>'
+    assert ''.join(iterdump(root)) == expected
+    chunks = list(iterdump(root, chunk_size=2))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == expected
+
+
+def test_dump_deep_tree():
+    depth = 5000
+    document = parse('<e>' * depth + 'leaf' + '</e>' * depth)
+    out = io.StringIO()
+    dump_document(document, out)
+    assert out.getvalue() == '<e>' * depth + 'leaf' + '</e>' * depth
+
+
+def test_dump_encoded(tmp_path):
+    document = parse('<a b="\u00e9">\u2603</a>')
+    assert b''.join(iterdump_document(document, 'latin-1')) == b'<?xml version="1.0" encoding="latin-1"?><a b="\xe9">&#9731;</a>'
+    out = io.BytesIO()
+    dump_document(document, out, 'utf-16')
+    assert parse_bytes(out.getvalue()).root.text == ['\u2603']
+    dump_file(document, tmp_path / 'out.xml')
+    assert snapshot(parse_file(tmp_path / 'out.xml').root) == snapshot(document.root)
+
+
+def test_wire_round_trip():
+    document = parse('<?xml version="1.0" encoding="utf-8"?><a x="1">t&amp;&#65;<b><c y="2"/>u</b></a>')
+    rebuilt = from_wire(to_wire(document))
+    assert snapshot(rebuilt.root) == snapshot(document.root)
+    assert rebuilt.root.children[0].parent is rebuilt.root
+    assert rebuilt.declaration == document.declaration
+    assert from_wire(to_wire(None)) is None
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_parse_many(executor, tmp_path):
+    path = tmp_path / 'document.xml'
+    path.write_bytes(b'<from-file/>')
+    sources = [f'<d n="{index}"/>' for index in range(40)] + [b'<bytes/>', path, '<broken>']
+    documents = list(parse_many(sources, workers=2, executor=executor, chunk_size=3))
+    assert [document.root.attributes['n'] for document in documents[:40]] == [str(index) for index in range(40)]
+    assert [document.root.name for document in documents[40:42]] == ['bytes', 'from-file']
+    assert documents[42] is None
+    unordered = dict(parse_many(sources[:40], workers=2, executor=executor, ordered=False, chunk_size=7))
+    assert sorted(unordered) == list(range(40))
+    assert all(unordered[index].root.attributes['n'] == str(index) for index in unordered)
+    with pytest.raises(ValueError):
+        list(parse_many(sources, executor='fiber'))
+
+
+def test_parse_split():
+    records = ''.join(f'<r n="{index}" q="a>b">x&amp;{index}<s/></r>\r\n' for index in range(50))
+    source = f'<?xml version="1.0"?><root k="v">\n{records}tail</root>'
+    expected = snapshot(parse(source).root)
+    assert snapshot(parse_split(source, workers=2, segments_per_worker=3).root) == expected
+    assert snapshot(parse_split(source.encode('utf-16'), workers=2).root) == expected
+    document = parse_split(source, workers=2)
+    assert document.declaration.version == '1.0'
+    assert all(child.parent is document.root for child in document.root.children)
+    # Comments fall back to the serial parser, malformed input gives None either way
+    assert parse_split(source.replace('tail', '<!-- <a> -->'), workers=2) is None
+    assert parse_split(source.replace('<s/>', '<s>', 1), workers=2) is None
+    assert parse_split(source.replace('</r>', '</t>', 1), workers=2) is None
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_bench_corpora_are_deterministic(shape):
+    text = generate(shape, 'small')
+    assert text == generate(shape, 'small')
+    assert parse(text) is not None
+    assert find_first(parse(text).root, lambda fragment: False) is None
+
+
+def test_bench_regressions():
+    baseline = {'wide/small/e4/parse': {'seconds': 1.0}, 'wide/small/etree/parse': {'seconds': 1.0}}
+    results = {'wide/small/e4/parse': {'seconds': 1.2}, 'wide/small/etree/parse': {'seconds': 2.0}}
+    assert regressions(results, baseline, 0.1) == [('wide/small/e4/parse', 1.0, 1.2)]
+    assert regressions(results, baseline, 0.25) == []
+
+
+def test_instrument():
+    import e4
+    original = e4.parse_name
+    with instrument() as profile:
+        assert e4.parse_name is not original
+        document = parse('<a x="1">t&#65;&amp;<b/></a>')
+        with pytest.raises(RuntimeError):
+            with instrument():
+                pass
+    assert e4.parse_name is original
+    assert snapshot(document.root) == snapshot(parse('<a x="1">t&#65;&amp;<b/></a>').root)
+    counters = profile.as_dict()
+    assert counters['parse_reference'] == {**counters['parse_reference'], 'calls': 2, 'characters': 10, 'backtracks': 0}
+    # '&amp;' is tried as a character reference first
+    assert counters['parse_char_reference']['calls'] == 2
+    assert counters['parse_char_reference']['backtracks'] == 1
+    assert counters['parse_start_tag']['calls'] == 2
+    assert counters['parse_document']['characters'] == 28
+    assert counters['parse_document']['seconds'] >= counters['parse_document']['own_seconds']
+    assert 'parse_name' in profile.report()
+
+
+def test_tokenize():
+    stream = tokenize('<?xml version="1.0"?>\r\n<a x="1" y=\'\'>t&#65;&amp;\r\n<b/><c>u</c ></a>')
+    assert stream.declaration.version == '1.0'
+    assert [(token.kind, token.value) for token in stream] == [
+        (TokenKind.START, 'a'), (TokenKind.ATTRIBUTE_NAME, 'x'), (TokenKind.ATTRIBUTE_VALUE, '1'),
+        (TokenKind.ATTRIBUTE_NAME, 'y'), (TokenKind.ATTRIBUTE_VALUE, ''),
+        (TokenKind.TEXT, 't'), (TokenKind.CHAR_REFERENCE, '&#65;'), (TokenKind.ENTITY_REFERENCE, '&amp;'),
+        (TokenKind.TEXT, '\n'), (TokenKind.START, 'b'), (TokenKind.END, 'b'),
+        (TokenKind.START, 'c'), (TokenKind.TEXT, 'u'), (TokenKind.END, 'c'), (TokenKind.END, 'a'),
+    ]
+    assert len(stream) == 15
+    assert stream.kind(-1 % len(stream)) == TokenKind.END and stream[-1].value == 'a'
+    assert stream.value(5) == 't' and stream.span(5) == (stream[5].start, stream[5].end)
+    assert next(stream.spans()) == (TokenKind.START, stream[0].start, stream[0].end)
+
+
+@pytest.mark.parametrize('source, position', [
+    ('<a>', 3),
+    ('<a></b>', 3),
+    ('<a x="<"/>', 2),
+    ('<a>&b</a>', 3),
+    ('<a>]]></a>', 3),
+    ('text', 0),
+])
+def test_tokenize_failures(source, position):
+    with pytest.raises(BadFormat) as error:
+        tokenize(source)
+    assert error.value.position == position
+
+
+def test_iterate_spans():
+    source = '<?xml version="1.0"?>\n<a x="1">t&amp;<b/></a>'
+    assert list(iterate_spans(source)) == list(tokenize(source).spans())
+    assert all(type(kind) is int for kind, _, _ in iterate_spans(source))
+    # Tokens before a problem are yielded before BadFormat is raised
+    spans = iterate_spans('<a>t<b></a>')
+    assert [next(spans) for _ in range(3)] == [(TokenKind.START, 1, 2), (TokenKind.TEXT, 3, 4), (TokenKind.START, 5, 6)]
+    with pytest.raises(BadFormat):
+        next(spans)
+
+
+def test_names_are_interned():
+    source = '<a k="1"><b k="2"/><b k="3"></b ></a>'
+    for document in (parse(source), parse_bytes(source.encode())):
+        first, second = document.root.children
+        assert first.name is second.name
+        assert list(first.attributes)[0] is list(second.attributes)[0] is list(document.root.attributes)[0]
+    parser = FeedParser()
+    parser.feed(source)
+    first, second = parser.close().root.children
+    assert first.name is second.name
+    names = {}
+    assert parse('<b/>', names).root.name is parse('<b></b>', names).root.name is names['b']
+    assert parse('<a></ab>') is None and parse('<ab></a>') is None and parse('<a></a >') is not None
+
+
+def test_resolve_references():
+    source = '<a>x &lt;&#65;&#x42;&amp;y<b>&undeclared;z</b>&#0;w&gt;</a>'
+    references = {}
+    document = parse(source, references=references)
+    assert snapshot(document.root) == ('a', {}, [
+        'x <AB&y', ('b', {}, [(FragmentType.ENTITY_REFERENCE, '&undeclared;'), 'z']),
+        (FragmentType.CHAR_REFERENCE, '&#0;'), 'w>'])
+    assert references == {'&lt;': '<', '&#65;': 'A', '&#x42;': 'B', '&amp;': '&', '&undeclared;': None, '&#0;': None, '&gt;': '>'}
+    assert parse('<a>&amp;</a>', references=references).root.text == ['&']
+    assert snapshot(parse(source).root)[2][0] == 'x '
+    out = io.StringIO()
+    dump_document(document, out)
+    assert out.getvalue() == '<a>x &lt;AB&amp;y<b>&undeclared;z</b>&#0;w></a>'
+    assert snapshot(parse(out.getvalue(), references={}).root) == snapshot(document.root)
+
+
+SELECTIVE_SOURCE = (
+    '<feed v="1">title<entry k="a"><id>1</id><body>x<p>&amp;</p></body></entry>'
+    '<meta><id>skip</id></meta><entry k="b"><id n="2">2&#65;</id><id/></entry><empty/></feed>'
+)
+
+
+def test_parse_selected_paths():
+    document = parse_selected(SELECTIVE_SOURCE, paths=['/feed/entry/id'])
+    assert snapshot(document.root) == ('feed', {'v': '1'}, [
+        ('entry', {'k': 'a'}, [('id', {}, ['1'])]),
+        ('entry', {'k': 'b'}, [('id', {'n': '2'}, ['2', (FragmentType.CHAR_REFERENCE, '&#65;')]), ('id', {}, [])]),
+    ])
+    assert document.root.children[0].parent is document.root
+    assert snapshot(parse_selected(SELECTIVE_SOURCE, paths=['/feed']).root) == snapshot(parse(SELECTIVE_SOURCE).root)
+    assert snapshot(parse_selected(SELECTIVE_SOURCE, paths=['/other/id']).root) == ('feed', {'v': '1'}, [])
+    # Long text ahead of a child must not make the scanner backtrack exponentially
+    source = SELECTIVE_SOURCE.replace('<meta>', '<meta>' + 'text &amp; ' * 200)
+    assert snapshot(parse_selected(source, paths=['/feed/entry/id']).root) == \
+        snapshot(parse_selected(SELECTIVE_SOURCE, paths=['/feed/entry/id']).root)
+
+
+def test_parse_selected_predicate():
+    document = parse_selected(SELECTIVE_SOURCE, predicate=lambda element: element.name == 'p' or 'n' in element.attributes)
+    assert snapshot(document.root) == ('feed', {'v': '1'}, [
+        ('entry', {'k': 'a'}, [('body', {}, [('p', {}, [(FragmentType.ENTITY_REFERENCE, '&amp;')])])]),
+        ('entry', {'k': 'b'}, [('id', {'n': '2'}, ['2', (FragmentType.CHAR_REFERENCE, '&#65;')])]),
+    ])
+
+
+def test_parse_selected_predicate_reading_views():
+    def predicate(element):
+        chain = element
+        while chain is not None:
+            chain.children, chain.text
+            chain = chain.parent
+        return element.name == 'p' or 'n' in element.attributes
+
+    document = parse_selected(SELECTIVE_SOURCE, predicate=predicate)
+    expected = parse_selected(SELECTIVE_SOURCE, predicate=lambda element: element.name == 'p' or 'n' in element.attributes)
+    for element, other in zip(iter_elements(document.root), iter_elements(expected.root)):
+        assert element.children == [child for child in element.fragments if isinstance(child, Element)]
+        assert child_count(element) == child_count(other) and element.text == other.text
+    assert [child.name for child in document.root.children] == ['entry', 'entry']
+    whole = parse_selected(SELECTIVE_SOURCE, predicate=lambda element: (element.children, element.text) and True)
+    assert snapshot(whole.root) == snapshot(parse(SELECTIVE_SOURCE).root)
+    assert whole.root.text == ['title'] and len(whole.root.children) == 4
+
+
+def iter_elements(root):
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        yield element
+        stack.extend(element.children)
+
+
+@pytest.mark.parametrize('broken', [
+    '<meta><id>skip</di></meta>', '<meta><id>&bad</id></meta>', '<meta>]]></meta>', '<meta x="<"/>', '<meta>',
+])
+def test_parse_selected_checks_skipped_subtrees(broken):
+    source = SELECTIVE_SOURCE.replace('<meta><id>skip</id></meta>', broken)
+    assert parse(source) is None
+    assert parse_selected(source, paths=['/feed/entry/id']) is None
+
+
+def test_cache_round_trip(tmp_path):
+    document = parse('<?xml version="1.0" encoding="utf-8"?><a x="1">t&amp;&#65;<b><c y="2"/>t</b><b/></a>')
+    rebuilt = decode(encode(document))
+    assert snapshot(rebuilt.root) == snapshot(document.root)
+    assert rebuilt.declaration == document.declaration
+    assert rebuilt.root.children[0].parent is rebuilt.root
+    dump_cache(document, tmp_path / 'a.e4c')
+    assert snapshot(load_cache(tmp_path / 'a.e4c').root) == snapshot(document.root)
+    for corrupt in (b'', b'<a/>', encode(document)[:-3]):
+        with pytest.raises(ValueError):
+            decode(corrupt)
+
+
+@pytest.mark.parametrize('by_hash', [False, True])
+def test_parse_cached(tmp_path, by_hash):
+    source = tmp_path / 'config.xml'
+    source.write_text('<config><item k="1"/></config>')
+    cache = tmp_path / 'config.xml.e4c'
+    assert parse_cached(source, by_hash=by_hash).root.children[0].attributes == {'k': '1'}
+    assert cache.exists()
+    # A cache with a matching key is loaded instead of the source
+    dump_cache(parse('<cached/>'), cache, source_key(source, by_hash))
+    assert parse_cached(source, by_hash=by_hash).root.name == 'cached'
+    source.write_text('<config><item k="22"/></config>')
+    assert parse_cached(source, by_hash=by_hash).root.children[0].attributes == {'k': '22'}
+    cache.write_bytes(b'garbage')
+    assert parse_cached(source, by_hash=by_hash).root.name == 'config'
+    source.write_text('<broken>')
+    assert parse_cached(source, by_hash=by_hash) is None
+
+
+def test_parse_cached_without_writable_cache(tmp_path, monkeypatch):
+    source = tmp_path / 'config.xml'
+    source.write_text('<config/>')
+    assert parse_cached(source, cache_path=tmp_path / 'missing' / 'config.e4c').root.name == 'config'
+
+    def fail(*arguments):
+        raise PermissionError('read-only')
+    monkeypatch.setattr('os.replace', fail)
+    assert parse_cached(source).root.name == 'config'
+    with pytest.raises(PermissionError):
+        dump_cache(parse('<a/>'), tmp_path / 'a.e4c')
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['config.xml']
+
+
+COLUMNS_SOURCE = (
+    '<table><row id="1" w="0.5">own<name>a&amp;b</name><n>10</n><name>ignored</name></row>'
+    '<other id="9"><n>99</n></other>'
+    '<row id="2"><n k="x">2<i>0</i></n><row id="3"/></row></table>'
+)
+
+
+def test_extract_columns():
+    columns = extract_columns(COLUMNS_SOURCE, 'row', {'id': '@id', 'weight': '@w', 'name': 'name', 'n': 'n', 'own': '.'})
+    assert columns == {'id': ['1', '2'], 'weight': ['0.5', None], 'name': ['a&b', None], 'n': ['10', '2'], 'own': ['own', '']}
+    typed = extract_columns(COLUMNS_SOURCE, 'row', {'id': '@id', 'weight': '@w', 'name': 'name'},
+                            converters={'id': int, 'weight': float, 'name': str.upper}, defaults={'weight': 1.0})
+    assert typed['id'] == array.array('q', [1, 2])
+    assert typed['weight'] == array.array('d', [0.5, 1.0])
+    assert typed['name'] == ['A&B', None]
+    with pytest.raises(ValueError):
+        extract_columns(COLUMNS_SOURCE, 'row', {'weight': '@w'}, converters={'weight': float})
+    assert extract_columns('<t/>', 'row', {'id': '@id'}) == {'id': []}
+
+
+def element_spans(document):
+    spans = []
+    stack = [document.root]
+    while stack:
+        element = stack.pop()
+        spans.append((element.name, *document.spans[element]))
+        stack.extend(reversed(element.children))
+    return spans
+
+
+def test_spans():
+    document = parse('<?xml version="1.0"?>\r\n<a><b x="1">t</b><c/>\r\n</a>', spans={})
+    assert document.source == '<?xml version="1.0"?>\n<a><b x="1">t</b><c/>\n</a>'
+    assert element_spans(document) == [('a', 22, 48), ('b', 25, 39), ('c', 39, 43)]
+    assert parse('<a/>').spans is None
+
+
+# Each edit replaces the first occurrence of old in the source
+@pytest.mark.parametrize('old, new_text', [
+    ('t</i>', 'XYZ</i>'),       # text inside <i>
+    ('ext', 'e<n>n</n>xt'),     # new element inside <b>
+    ('t</a>', '</a>'),          # text at the end of <a>, after <c/>
+    ('"1"', '"2"'),             # attribute value of <b>
+    ('<c/>', '<d/>'),           # replaces an empty element
+    ('<c/>', '<c>'),            # leaves <c> unclosed
+    ('<a>', '<z>'),             # root start tag only: mismatched end tag
+    ('<a>', ' <a>'),            # before the root
+    ('ext', 'e</b><b>xt'),      # splits <b> in two
+    ('</i>', ''),               # leaves <i> unclosed inside <b>
+])
+def test_reparse(old, new_text):
+    source = '<a><b k="1"><i>t</i>ext</b>\n<c/>t</a>'
+    edit_start = source.index(old)
+    edit_end = edit_start + len(old)
+    document = parse(source, spans={})
+    old_root = document.root
+    edited = source[:edit_start] + new_text + source[edit_end:]
+    expected = parse(edited, spans={})
+    result = reparse(document, edit_start, edit_end, new_text)
+    if expected is None:
+        assert result is None
+        assert document.root is old_root and document.source == source
+        return
+    assert result is document
+    assert document.source == edited
+    assert snapshot(document.root) == snapshot(expected.root)
+    assert element_spans(document) == element_spans(expected)
+    assert len(document.spans) == len(expected.spans)
+    assert all(child.parent is element for element in document.spans for child in element.children)
+
+
+def test_reparse_keeps_untouched_subtrees():
+    document = parse('<a><b>1</b><c>2</c></a>', spans={})
+    b, c = document.root.children
+    reparse(document, 14, 15, 'two')
+    assert document.root.children[0] is b and document.root.children[1] is not c
+    assert snapshot(document.root) == snapshot(parse('<a><b>1</b><c>two</c></a>').root)
+    with pytest.raises(ValueError):
+        reparse(parse('<a/>'), 0, 0, '')
+    with pytest.raises(ValueError):
+        reparse(document, 5, 100, '')
+
+
+def test_line_index():
+    index = LineIndex('ab\ncd\n\ne')
+    assert [index.line_column(offset) for offset in range(9)] == [
+        (1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3), (3, 1), (4, 1), (4, 2)]
+
+
+def test_parse_strict():
+    assert snapshot(parse_strict('<a>t</a>').root) == snapshot(parse('<a>t</a>').root)
+    with pytest.raises(BadFormat) as error:
+        parse_strict('<a>\r\n  <b>\r\n</a>')
+    assert error.value.position == 13
+    assert error.value.line_column == (3, 4)
+    assert str(error.value) == 'malformed document at offset 13'
+    assert BadFormat('message', 3).line_column is None
+    with pytest.raises(BadFormat) as error:
+        tokenize('<a>\n  <b x=1/>\n</a>')
+    assert error.value.line_column == (2, 5)
+
+
+def test_parse_strict_normalizes_once(monkeypatch):
+    import e4
+    calls = []
+    normalize = e4.normalize_end_of_line
+    monkeypatch.setattr(e4, 'normalize_end_of_line', lambda text: calls.append(text) or normalize(text))
+    assert parse_strict('<a>\r\n</a>').root.text == ['\n']
+    assert calls == ['<a>\r\n</a>']
+
+
+def test_document_line_column():
+    document = parse('<a>\n  <b>\n    <c/>\n  </b>\n</a>', spans={})
+    b = document.root.children[0]
+    assert document.line_column(document.root) == (1, 1)
+    assert document.line_column(b) == (2, 3)
+    assert document.line_column(b.children[0]) == (3, 5)
+    reparse(document, 0, 0, '\n\n')
+    assert document.line_column(document.root.children[0].children[0]) == (5, 5)
+    with pytest.raises(ValueError):
+        parse('<a/>').line_column(None)
+
+
+def test_views_are_read_only():
+    document = parse('<a>t<b/><c/></a>')
+    a = document.root
+    b, c = a.children
+    for mutate in [lambda view: view.reverse(), lambda view: view.remove(view[0]), lambda view: view.append(None),
+                   lambda view: view.__setitem__(0, None), lambda view: view.__delitem__(0)]:
+        with pytest.raises(TypeError):
+            mutate(a.children)
+        with pytest.raises(TypeError):
+            mutate(a.text)
+    assert a.children == [b, c] and child_count(a) == 2 and nth_child(a, 0) is b
+    assert a.text == ['t']
+    copied = list(a.children)
+    copied.reverse()
+    assert copied == [c, b] and a.children == [b, c]
+    for view in [pickle.loads(pickle.dumps(a.children)), copy.deepcopy(a.text)]:
+        with pytest.raises(TypeError):
+            view.reverse()
+    assert snapshot(copy.deepcopy(a)) == snapshot(a)
+
+
+def test_append_keeps_cached_views():
+    document = parse('<a>t<b/></a>')
+    a = document.root
+    assert a.children and a.text == ['t']
+    c = Element(name='c')
+    append_child(a, c)
+    append_text(a, 'u')
+    assert a.children == [a.fragments[1], c] and c.parent is a
+    assert a.text == ['t', 'u']
+    assert document.find_all('c') == [c]
+    d = Element(name='d')
+    append_child(a, d)
+    assert document.find_all('d') == [d]
+
+
+def test_extend_children():
+    document = parse('<a>t</a>')
+    a = document.root
+    assert document.find_all('b') == [] and a.text == ['t']
+    b = Element(name='b')
+    extend_children(a, ['u', 'v', b, 'w', Fragment(kind=FragmentType.ENTITY_REFERENCE, data='amp'), 'x'])
+    assert a.fragments[:3] == ['tuv', b, 'w'] and a.fragments[4:] == ['x']
+    assert b.parent is a and a.children == [b] and a.text == ['tuv', 'w', 'amp', 'x']
+    assert document.find_all('b') == [b]
+
+
+def test_clone():
+    root = parse('<a x="1"><b>t&amp;</b><c/></a>').root
+    copied = clone(root)
+    assert copied.children[1]._attributes is None
+    assert snapshot(copied) == snapshot(root) and copied.parent is None
+    assert copied.children[0].parent is copied
+    assert copied.attributes is not root.attributes
+    copied.children[0].fragments[1].data = '&lt;'
+    assert root.children[0].fragments[1].data == '&amp;'
+
+
+def test_tree_builder():
+    builder = TreeBuilder()
+    builder.start('a', {'x': '1'})
+    builder.data('t')
+    builder.data('u')
+    builder.leaf('b', None, 'v')
+    builder.extend(['w', clone(parse('<c/>').root), ''])
+    builder.data('')
+    builder.end('a')
+    root = builder.close()
+    assert snapshot(root) == snapshot(parse('<a x="1">tu<b>v</b>w<c/></a>').root)
+    assert root.children[1].parent is root
+    with pytest.raises(ValueError):
+        builder.start('d')
+    builder = TreeBuilder()
+    with pytest.raises(ValueError):
+        builder.data('t')
+    builder.start('a')
+    with pytest.raises(ValueError):
+        builder.end('b')
+    shared = {'k': '1'}
+    first = builder.leaf('b', shared)
+    second = builder.start('c', shared)
+    builder.end()
+    first.attributes['k'] = '2'
+    assert second.attributes == shared == {'k': '1'}
+    builder.data('t')
+    with pytest.raises(ValueError):
+        builder.close()
+    assert builder.end('a').fragments[2:] == ['t']
+    assert builder.close().name == 'a'
+    with pytest.raises(ValueError):
+        TreeBuilder().close()
+
+
+def test_tree_builder_keeps_views_current():
+    builder = TreeBuilder()
+    a = builder.start('a')
+    assert a.children == [] and a.text == []
+    builder.data('t')
+    b = builder.start('b')
+    assert a.children == [b] and child_count(a) == 1 and a.text == ['t']
+    builder.end('b')
+    c = builder.leaf('c')
+    assert a.children == [b, c] and nth_child(a, 1) is c
+    reference = Fragment(kind=FragmentType.ENTITY_REFERENCE, data='&amp;')
+    d = Element(name='d')
+    builder.extend(['u', reference, d])
+    assert a.children == [b, c, d] and a.text == ['t', 'u', '&amp;']
+    builder.data('v')
+    builder.end('a')
+    assert a.text == ['t', 'u', '&amp;', 'v']
+    assert snapshot(builder.close()) == snapshot(parse('<a>t<b/><c/>u&amp;<d/>v</a>').root)
+
+
+def test_bench_build():
+    results = run_build(30, repeat=1, memory=False)
+    assert set(results) == {'build/30/e4/build', 'build/30/e4/build_from_template', 'build/30/e4/build_and_dump',
+                            'build/30/etree/build', 'build/30/etree/build_and_dump'}
+
+
+def test_bench_scaling():
+    results = run_scaling('wide', 'small', documents=3, workers=[2, 1], repeat=1)
+    prefix = 'scaling/wide-small-x3/e4/'
+    assert set(results) == {prefix + operation for operation in ['parse_serial', 'parse_many-thread-1', 'parse_many-thread-2',
+                                                                 'parse_many-process-1', 'parse_many-process-2']}
+    assert results[prefix + 'parse_many-process-1']['speedup'] == 1
+    assert results[prefix + 'parse_many-thread-2']['speedup'] > 0
+    assert results[prefix + 'parse_serial']['speedup'] is None
+
+
 # def test_failure_mismatching_tags_no_space():
 #     with pytest.raises(BadFormat):
 #         parse('<element> </other>')